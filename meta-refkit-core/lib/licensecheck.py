@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # ex:ts=4:sw=4:sts=4:et
 # -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
 #
@@ -9,7 +9,8 @@
 #
 #   1. Bitbake doesn't allow us to find out runtime dependencies without
 #   building the whole image. We can't use the tinfoil API for this reason, but
-#   instead we are using oe-pkg-util for finding out package (not recipe)
+#   instead we are reading the pkgdata directory (or, if that is not
+#   available, using oe-pkg-util) for finding out package (not recipe)
 #   licenses and runtime dependencies. See bug
 #   https://bugzilla.yoctoproject.org/show_bug.cgi?id=10932 for discussion.
 #
@@ -33,13 +34,27 @@
 # Especially the dual-licensing rules are not very accurate due to the way
 # Bitbake recipes express dual-licensing and multi-licensing.
 #
+# The module can also be run as a script for checking a whole image:
+#
+#   licensecheck.py --pkgdata-dir tmp/pkgdata/<machine> --prohibited GPLv3 \
+#       --prohibited LGPLv3 --output report.json \
+#       tmp/deploy/licenses/<image>/package.manifest
+#
+# The JSON report lists the packages which failed, together with the
+# shortest dependency paths to the packages causing the failure.
+#
 # AUTHORS
 # Ismo Puustinen <ismo.puustinen@intel.com>
 
 import os
+import sys
 import unittest
 import re
 import glob
+import json
+import pickle
+import argparse
+import concurrent.futures
 from shutil import rmtree, copy
 import subprocess
 
@@ -63,6 +78,215 @@ class LicenseNode():
         for child in self.children:
             child.printTree(indent + 1)
 
+def parseRdepends(rdepends):
+    # Package names in a RDEPENDS value, without version constraints.
+    return [token for token in rdepends.strip().split() if not token[0] == "(" and not token[-1] == ")"]
+
+class PkgdataIndex():
+
+    # In-memory copy of the package information in PKGDATA_DIR. All
+    # packages are read in one pass over the "runtime" directory and the
+    # "runtime-reverse" links. The lookups return the same values as the
+    # corresponding oe-pkgdata-util commands.
+    #
+    # The values read from each file are also stored in an on-disk cache
+    # together with the file's modification time and size. Later runs
+    # (selftests or command line) only read the files which changed.
+    #
+    # The generation gets incremented whenever an update finds changes,
+    # so users of the index can tell whether their own results derived
+    # from it are still valid.
+
+    # Bump when changing the content of the cache file.
+    cacheVersion = 1
+
+    def __init__(self, pkgdataDir, cacheFile=None):
+        self.pkgdataDir = pkgdataDir
+        if cacheFile is None:
+            # Next to PKGDATA_DIR (${TMPDIR}/pkgdata/${MACHINE}), so that it
+            # gets removed together with the rest of TMPDIR.
+            cacheFile = os.path.join(os.path.dirname(os.path.abspath(pkgdataDir)),
+                                     "licensecheck-%s.cache" % os.path.basename(os.path.abspath(pkgdataDir)))
+        self.cacheFile = cacheFile
+        # package name -> ((mtime, size), values) for each runtime file
+        self.files = {}
+        # (mtime, size) of the runtime-reverse directory and its content
+        self.reverseStamp = None
+        self.reverse = {}
+        self.generation = 0
+        self._loadCache()
+        self.update()
+
+    def _loadCache(self):
+        try:
+            with open(self.cacheFile, "rb") as f:
+                cache = pickle.load(f)
+            if cache["version"] == PkgdataIndex.cacheVersion and \
+               cache["pkgdataDir"] == os.path.abspath(self.pkgdataDir):
+                self.files = cache["files"]
+                self.reverseStamp = cache["reverseStamp"]
+                self.reverse = cache["reverse"]
+        except Exception:
+            # Missing or unusable, start from scratch.
+            pass
+
+    def _saveCache(self):
+        cache = {
+            "version": PkgdataIndex.cacheVersion,
+            "pkgdataDir": os.path.abspath(self.pkgdataDir),
+            "files": self.files,
+            "reverseStamp": self.reverseStamp,
+            "reverse": self.reverse,
+        }
+        tmpFile = "%s.%d" % (self.cacheFile, os.getpid())
+        try:
+            with open(tmpFile, "wb") as f:
+                pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFile, self.cacheFile)
+        except OSError as e:
+            print("Could not write pkgdata cache %s: %s" % (self.cacheFile, e))
+
+    def update(self):
+        """Bring the index up-to-date with the content of PKGDATA_DIR.
+
+        Only files which are new or were modified get read. Returns True
+        if anything changed.
+        """
+
+        runtimeDir = os.path.join(self.pkgdataDir, "runtime")
+        reverseDir = os.path.join(self.pkgdataDir, "runtime-reverse")
+        changed = False
+
+        files = {}
+        for package in os.listdir(runtimeDir):
+            st = os.stat(os.path.join(runtimeDir, package))
+            stamp = (st.st_mtime_ns, st.st_size)
+            entry = self.files.get(package, None)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, self._readPackage(os.path.join(runtimeDir, package), package))
+                changed = True
+            files[package] = entry
+        if len(files) != len(self.files):
+            changed = True
+        self.files = files
+
+        # Links get added and removed, but not modified, so the
+        # directory itself tells us whether we need to read them again.
+        st = os.stat(reverseDir)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp != self.reverseStamp:
+            self.reverse = {}
+            for runtimePackage in os.listdir(reverseDir):
+                self.reverse[runtimePackage] = os.path.basename(os.readlink(os.path.join(reverseDir, runtimePackage)))
+            self.reverseStamp = stamp
+            changed = True
+
+        if changed or not os.path.exists(self.cacheFile):
+            self._saveCache()
+        if changed or not hasattr(self, "recipes"):
+            self._createMaps()
+        if changed:
+            self.generation += 1
+        return changed
+
+    def _createMaps(self):
+        self.recipes = {}    # runtime package name -> recipe (lookup-recipe)
+        self.packages = {}   # package name -> runtime package name (lookup-pkg)
+        self.licenses = {}   # runtime package name -> LICENSE (read-value)
+        self.rdepends = {}   # runtime package name -> runtime packages in RDEPENDS
+        self.unknown = {}    # runtime package name -> RDEPENDS without package data
+
+        for package, entry in self.files.items():
+            if "PKG" in entry[1]:
+                self.packages[package] = entry[1]["PKG"]
+
+        for runtimePackage, package in self.reverse.items():
+            if not package in self.files:
+                continue
+            packageValues = self.files[package][1]
+            if "PN" in packageValues:
+                self.recipes[runtimePackage] = packageValues["PN"]
+            self.licenses[runtimePackage] = packageValues.get("LICENSE", "")
+
+        for runtimePackage in self.licenses:
+            rdepends = parseRdepends(self.files[self.reverse[runtimePackage]][1].get("RDEPENDS", ""))
+            self.rdepends[runtimePackage] = [self.packages[d] for d in rdepends if self.packages.get(d, None)]
+            unknown = [d for d in rdepends if not self.packages.get(d, None)]
+            if unknown:
+                self.unknown[runtimePackage] = unknown
+
+    def _readPackage(self, filename, package):
+        # Same parsing rules as in oe-pkgdata-util: the first PN and
+        # PKG_<package> entries are used, for other variables the last
+        # one with or without package suffix wins.
+        result = {}
+        with open(filename, encoding="utf-8") as f:
+            for line in f:
+                name = line.split(":", 1)[0]
+                if name == "PN":
+                    if not "PN" in result:
+                        result["PN"] = line.split(":", 1)[1].strip()
+                elif name == "PKG_" + package:
+                    if not "PKG" in result:
+                        result["PKG"] = line.rstrip().split(": ")[1]
+                else:
+                    for var in ("LICENSE", "RDEPENDS"):
+                        if name in (var, var + "_" + package):
+                            result[var] = line.split(": ", 1)[1].rstrip()
+        return result
+
+class LicenseTable():
+
+    # The license compatibility tables compiled into integer bit masks.
+    # Every license name gets a bit the first time it is seen, so sets
+    # of licenses become integers and checking a dependency against the
+    # "allowed" and "disallowed" lists of a license is a single "and".
+
+    def __init__(self, allowed, disallowed):
+        self.bits = {}      # license name -> bit
+        self.names = []     # bit index -> license name
+        self.good = []      # bit index -> mask of allowed licenses
+        self.bad = []       # bit index -> mask of disallowed licenses
+        for table in (allowed, disallowed):
+            for license, licenses in sorted(table.items()):
+                self.bit(license)
+                for l in licenses:
+                    self.bit(l)
+        for license, licenses in allowed.items():
+            self.good[self.names.index(license)] = self.mask(licenses)
+        for license, licenses in disallowed.items():
+            self.bad[self.names.index(license)] = self.mask(licenses)
+
+    def bit(self, license):
+        b = self.bits.get(license, 0)
+        if not b:
+            # Licenses not in the tables have neither allowed nor
+            # disallowed licenses.
+            b = 1 << len(self.names)
+            self.bits[license] = b
+            self.names.append(license)
+            self.good.append(0)
+            self.bad.append(0)
+        return b
+
+    def mask(self, licenses):
+        m = 0
+        for l in licenses:
+            m |= self.bit(l)
+        return m
+
+    def indices(self, mask):
+        # Bit indices set in the mask, lowest first.
+        i = 0
+        while mask:
+            if mask & 1:
+                yield i
+            mask >>= 1
+            i += 1
+
+    def licenses(self, mask):
+        return set(self.names[i] for i in self.indices(mask))
+
 class LicenseCheck():
 
     # This table contains the "allowed" licenses. It means that a package
@@ -137,7 +361,28 @@ class LicenseCheck():
     rdepsCache = {}
     licenseCache = {}
 
-    def __init__(self, whitelistFile=None, prohibited=[]):
+    # Compiled form of the tables above, created on first use. Parsed
+    # LICENSE strings (as masks) and solved constraints are cached,
+    # because the same values occur for many packages.
+    licenseTable = None
+    licenseStringCache = {}
+    licenseMaskCache = {}
+    constraintCache = {}
+
+    # PkgdataIndex instances, shared by all LicenseCheck instances
+    # using the same PKGDATA_DIR.
+    pkgdataIndexes = {}
+
+    # PKGDATA_DIR and generation of the PkgdataIndex which the caches
+    # above and below were filled from.
+    cacheGeneration = None
+
+    # Propagated licenses per package. The result depends on the
+    # prohibited licenses and the whitelist, so there is one cache for
+    # each combination of those.
+    propagatedCache = {}
+
+    def __init__(self, whitelistFile=None, prohibited=[], pkgdataDir=None, pkgdataCache=None, pkgdataIndex=None):
         """Initialize the licensecheck object.
         
         A LicenseCheck object is used to analyse runtime licensing of
@@ -154,17 +399,70 @@ class LicenseCheck():
         another process. The 'prohibited' parameter contains a list of
         licenses which are prohibited for any reason. For example, to
         prevent (L)GPLv3 licenses, set prohibited = ["GPLv3", "LGPLv3"].
+        The 'pkgdataDir' parameter points to the PKGDATA_DIR of the
+        build. If set, package information is read from there directly
+        in one go instead of calling oe-pkgdata-util for each package.
+        The information is also cached in the 'pkgdataCache' file (by
+        default next to PKGDATA_DIR) and only files which changed since
+        the previous run are read again. Alternatively, an already loaded
+        PkgdataIndex can be given in 'pkgdataIndex', which then gets used
+        as it is.
         """
 
         self.whiteList = []
         self.prohibited = prohibited
+        self.whitelistFile = whitelistFile
+        self.pkgdataDir = pkgdataDir
+        self.pkgdataCache = pkgdataCache
+        self.pkgdata = pkgdataIndex
+        if pkgdataIndex:
+            self.pkgdataDir = pkgdataIndex.pkgdataDir
+        elif pkgdataDir and os.path.isdir(os.path.join(pkgdataDir, "runtime-reverse")):
+            self.pkgdata = LicenseCheck.pkgdataIndexes.get(pkgdataDir, None)
+            if self.pkgdata is None:
+                self.pkgdata = PkgdataIndex(pkgdataDir, pkgdataCache)
+                LicenseCheck.pkgdataIndexes[pkgdataDir] = self.pkgdata
+            else:
+                # Packages might have been rebuilt since the previous
+                # instance was created.
+                self.pkgdata.update()
+        if LicenseCheck.licenseTable is None:
+            LicenseCheck.licenseTable = LicenseTable(LicenseCheck.allowed, LicenseCheck.disallowed)
+        self.table = LicenseCheck.licenseTable
+        self.prohibitedMask = self.table.mask(self.prohibited)
         if whitelistFile:
             with open(whitelistFile) as f:
                 lines = f.readlines()
                 for line in lines:
                     self.whiteList.append(line.strip())
+        self.propagatedKey = (frozenset(self.prohibited), frozenset(self.whiteList))
+        self.propagated = LicenseCheck.propagatedCache.setdefault(self.propagatedKey, {})
+        self.generation = None
+        self._checkGeneration()
+
+    def _checkGeneration(self):
+        # Called whenever the public API is used. When the shared
+        # PkgdataIndex was updated since the caches were filled, for
+        # example by a newer instance, all cached results are obsolete,
+        # including those in self.propagated.
+        if self.pkgdata is None or self.generation == self.pkgdata.generation:
+            return
+        generation = (self.pkgdataDir, self.pkgdata.generation)
+        if LicenseCheck.cacheGeneration != generation:
+            for cache in (LicenseCheck.packageCache, LicenseCheck.recipeCache,
+                          LicenseCheck.rdepsCache, LicenseCheck.licenseCache,
+                          LicenseCheck.propagatedCache):
+                cache.clear()
+            LicenseCheck.cacheGeneration = generation
+        self.generation = self.pkgdata.generation
+        self.propagated = LicenseCheck.propagatedCache.setdefault(self.propagatedKey, {})
 
     def _parseLicenseString(self, s):
+        if s in LicenseCheck.licenseStringCache:
+            return list(LicenseCheck.licenseStringCache[s])
+
+        licenseString = s
+
         # Replace & with |. The reasoning is that typically for projects with
         # multiple licenses the most liberal licenses are used for libraries.
         # This is of course not certain, but a good approximation.
@@ -185,83 +483,93 @@ class LicenseCheck():
             else:
                 finalLicenses.append(l)
 
-        return finalLicenses
+        LicenseCheck.licenseStringCache[licenseString] = finalLicenses
+        return list(finalLicenses)
+
+    def _licenseMask(self, s):
+        # _parseLicenseString() as a mask, cached per LICENSE string.
+        mask = LicenseCheck.licenseMaskCache.get(s, None)
+        if mask is None:
+            mask = self.table.mask(self._parseLicenseString(s))
+            LicenseCheck.licenseMaskCache[s] = mask
+        return mask
 
     def _calculateConstraints(self, constraints, licenses, degradedLicenses):
-        # Every sublist in constraints list is how a single package dependency
+        # Set-based interface to _solveConstraints(), used for LicenseNode
+        # trees.
+        mask = self._solveConstraints(tuple(self.table.mask(c) for c in constraints),
+                                      self.table.mask(licenses),
+                                      self.table.mask(degradedLicenses))
+        return self.table.licenses(mask)
+
+    def _solveConstraints(self, constraints, licenses, degraded=0):
+        # Every mask in constraints is how a single package dependency
         # is licensed. Find the least restrictive outbound licenses for this
         # package.
 
         # Go through all the licenses that are compatible with the top package
         # and see if all dependencies could be used from code licensed with that
-        # license.
-
-        if len(licenses) == 0 or len(licenses - degradedLicenses) == 0:
-            return set()
-
-        candidateLicenses = licenses.copy()
-
-        for license in licenses:
-            if license in LicenseCheck.disallowed:
-                bad = LicenseCheck.disallowed[license]
-            else:
-                bad = []
-
-            if license in LicenseCheck.allowed:
-                good = LicenseCheck.allowed[license]
-            else:
-                good = []
-
-            for dependencyLicenses in constraints:
-                possible = False
-                compatibleLicenses = set()
-                for dependencyLicense in dependencyLicenses:
-                    if dependencyLicense in bad:
-                        # Can't use this license, see other top-level licenses
-                        # for this dependency.
+        # license. Repeat with the resulting candidate licenses until they no
+        # longer change. This is guaranteed to finish: a license only gets
+        # added together with a new degraded license, otherwise the
+        # candidates can only shrink.
+
+        key = (constraints, licenses, degraded, self.prohibitedMask)
+        result = LicenseCheck.constraintCache.get(key, None)
+        if result is not None:
+            return result
+
+        good = self.table.good
+        bad = self.table.bad
+        while True:
+            if not licenses & ~degraded:
+                result = 0
+                break
+
+            added = 0
+            removed = 0
+            for i in self.table.indices(licenses):
+                license = 1 << i
+                for dependencyLicenses in constraints:
+                    if dependencyLicenses & good[i]:
+                        # This license can be used as-is.
                         continue
-                    elif dependencyLicense in good:
-                        possible = True
-                        # This license can be used as-is. Cancel previous
-                        # degradations.
-                        compatibleLicenses.clear()
-                        break
-                    else:
-                        possible = True
-                        # We can possibly degrade to this license. Save it for
-                        # next round if the top-level license candidate hasn't
-                        # been already degraded.
-                        if not license in degradedLicenses:
-                            compatibleLicenses.add(dependencyLicense)
-
-                # Can we handle this dependency with this top-level license?
-                if not possible:
-                    if license in candidateLicenses:
-                        candidateLicenses.remove(license)
-                elif len(compatibleLicenses) > 0:
-                    # We need to degrade our top-level license into something
-                    # that is supported by the dependency license. Then we need
-                    # to go through the dependencies again to see if this
-                    # license fits. The algorithm doesn't yet support finding
-                    # "common ancestor" licenses, but instead we just degrade to
-                    # the licenses that the dependency has and are compatible.
-                    candidateLicenses = candidateLicenses.union(compatibleLicenses)
-                    degradedLicenses.add(license)
-                # Else we can directly use this license.
-
-        if candidateLicenses == licenses:
-            # The license set didn't change and is stable. We can go with it.
-            return licenses - degradedLicenses - set(self.prohibited)
-
-        # Else check the dependencies again with the new candidateLicenses. This
-        # is guaranteed to finish if the license degradation graph is acyclical.
-        return self._calculateConstraints(constraints, candidateLicenses, degradedLicenses)
+                    compatible = dependencyLicenses & ~bad[i]
+                    if not compatible:
+                        # Can't handle this dependency with this top-level
+                        # license.
+                        removed |= license
+                    elif not degraded & license:
+                        # We need to degrade our top-level license into
+                        # something that is supported by the dependency
+                        # license. The algorithm doesn't yet support finding
+                        # "common ancestor" licenses, but instead we just
+                        # degrade to the licenses that the dependency has and
+                        # are compatible.
+                        added |= compatible
+                        degraded |= license
+
+            # A license which can't handle some dependency stays out,
+            # even when degrading another license would bring it in.
+            candidates = (licenses | added) & ~removed
+            if candidates == licenses:
+                # The license set didn't change and is stable. We can go with it.
+                result = licenses & ~degraded & ~self.prohibitedMask
+                break
+            licenses = candidates
+
+        LicenseCheck.constraintCache[key] = result
+        return result
 
     def _getRecipe(self, package):
         if package in LicenseCheck.packageCache:
             return LicenseCheck.packageCache[package]
 
-        rRecipeProp = subprocess.check_output(["oe-pkgdata-util", "lookup-recipe", package]).decode("utf-8").strip()
+        if self.pkgdata and package in self.pkgdata.recipes:
+            rRecipeProp = self.pkgdata.recipes[package]
+        else:
+            # Also used for reporting the error about unknown packages.
+            rRecipeProp = subprocess.check_output(["oe-pkgdata-util", "lookup-recipe", package]).decode("utf-8").strip()
 
         LicenseCheck.packageCache[package] = rRecipeProp
         return rRecipeProp
@@ -270,10 +578,15 @@ class LicenseCheck():
         rPackageProp = None
         if recipe in LicenseCheck.recipeCache:
             return LicenseCheck.recipeCache[recipe]
-        try:
-            rPackageProp = subprocess.check_output(["oe-pkgdata-util", "lookup-pkg", recipe]).decode("utf-8").strip()
-        except subprocess.CalledProcessError:
-            print("'oe-pkgdata-util lookup-pkg %s' failed!" % recipe)
+        if self.pkgdata:
+            rPackageProp = self.pkgdata.packages.get(recipe, None)
+            if not rPackageProp:
+                print("Package %s not found in pkgdata!" % recipe)
+        else:
+            try:
+                rPackageProp = subprocess.check_output(["oe-pkgdata-util", "lookup-pkg", recipe]).decode("utf-8").strip()
+            except subprocess.CalledProcessError:
+                print("'oe-pkgdata-util lookup-pkg %s' failed!" % recipe)
 
         LicenseCheck.recipeCache[recipe] = rPackageProp
         return rPackageProp
@@ -282,9 +595,16 @@ class LicenseCheck():
         if package in LicenseCheck.rdepsCache:
             return LicenseCheck.rdepsCache[package]
 
-        rundepsProp = subprocess.check_output(["oe-pkgdata-util", "read-value", "RDEPENDS", package]).decode("utf-8")
-        rundeps = [token for token in rundepsProp.strip().split() if not token[0] == "(" and not token[-1] == ")"]
-        rRundeps = filter(None, [self._getPackage(package) for package in rundeps])
+        if self.pkgdata:
+            # Already resolved by the index.
+            rRundeps = self.pkgdata.rdepends.get(package, [])
+            for recipe in self.pkgdata.unknown.get(package, []):
+                self._getPackage(recipe)
+        else:
+            rundepsProp = subprocess.check_output(["oe-pkgdata-util", "read-value", "RDEPENDS", package]).decode("utf-8")
+            rundeps = parseRdepends(rundepsProp)
+            # A list and not an iterator, because cached values get used more than once.
+            rRundeps = [p for p in [self._getPackage(package) for package in rundeps] if p]
 
         LicenseCheck.rdepsCache[package] = rRundeps
         return rRundeps
@@ -293,7 +613,10 @@ class LicenseCheck():
         if package in LicenseCheck.licenseCache:
             return LicenseCheck.licenseCache[package]
 
-        licenseProp = subprocess.check_output(["oe-pkgdata-util", "read-value", "LICENSE", package]).decode("utf-8")
+        if self.pkgdata:
+            licenseProp = self.pkgdata.licenses.get(package, "")
+        else:
+            licenseProp = subprocess.check_output(["oe-pkgdata-util", "read-value", "LICENSE", package]).decode("utf-8")
 
         LicenseCheck.licenseCache[package] = licenseProp
         return licenseProp
@@ -323,7 +646,198 @@ class LicenseCheck():
 
         return results
 
-    # Public API methods: propagate, createTree and testPackage.
+    def _getChildren(self, package):
+        # Runtime dependencies which need to be considered for the package.
+        return [d for d in self._getRdeps(package)
+                if d != package and not self._getRecipe(d) in self.whiteList]
+
+    def _findComponents(self, package, getChildren, known):
+        # Tarjan's algorithm, without recursion. Returns the strongly
+        # connected components of the dependency graph below the package,
+        # dependencies first. Packages in 'known' (with results from
+        # earlier calls) are skipped.
+        index = {}
+        lowlink = {}
+        stack = []
+        onStack = set()
+        components = []
+        work = [(package, iter(getChildren(package)))]
+        index[package] = lowlink[package] = 0
+        stack.append(package)
+        onStack.add(package)
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child in known:
+                    # Already calculated earlier, no need to go further down.
+                    continue
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    onStack.add(child)
+                    work.append((child, iter(getChildren(child))))
+                    break
+                elif child in onStack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onStack.remove(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+        return components
+
+    def _propagateNode(self, package, constraints):
+        licenses = self._licenseMask(self._getLicenses(package))
+        if len(constraints) == 0:
+            # Push local constraints up! If some licenses are
+            # prohibited, just don't propagate them.
+            return licenses & ~self.prohibitedMask
+        return self._solveConstraints(tuple(constraints), licenses)
+
+    def _propagatePackage(self, package):
+        # Calculates the propagated licenses for the package and all its
+        # dependencies, visiting each package only once. Packages which
+        # depend on each other (directly or indirectly) get evaluated
+        # together, until their results no longer change.
+        if package in self.propagated:
+            return self.propagated[package]
+
+        for component in self._findComponents(package, self._getChildren, self.propagated):
+            if component[0] in self.propagated:
+                continue
+            members = set(component)
+            if len(component) == 1:
+                children = self._getChildren(component[0])
+                self.propagated[component[0]] = self._propagateNode(component[0],
+                    [self.propagated[d] for d in children])
+                continue
+
+            # Start without the dependencies inside the component, then
+            # add those. A loop cannot be unrolled further than the
+            # number of packages in it.
+            current = {}
+            for member in component:
+                children = self._getChildren(member)
+                current[member] = self._propagateNode(member,
+                    [self.propagated[d] for d in children if not d in members])
+            for i in range(len(component)):
+                updated = {}
+                for member in component:
+                    children = self._getChildren(member)
+                    updated[member] = self._propagateNode(member,
+                        [current[d] if d in members else self.propagated[d] for d in children])
+                if updated == current:
+                    break
+                current = updated
+            self.propagated.update(current)
+
+        return self.propagated[package]
+
+    def _printGraph(self, package):
+        # Like LicenseNode.printTree(), but each package is only expanded once.
+        printed = set()
+        work = [(package, 0)]
+        while work:
+            package, indent = work.pop()
+            licenses = self._parseLicenseString(self._getLicenses(package))
+            propagated = self.table.licenses(self.propagated.get(package, 0))
+            line = package + ": " + str(licenses) + " -> " + str(sorted(propagated))
+            if package in printed:
+                print(indent * "\t" + line + " (see above)")
+                continue
+            print(indent * "\t" + line)
+            printed.add(package)
+            for child in reversed(self._getChildren(package)):
+                work.append((child, indent + 1))
+
+    def _findComponentGroups(self, packages):
+        # Splits the packages into groups which do not share any
+        # dependencies (ignoring packages with known results), so that
+        # they can be evaluated independently.
+        owner = {}
+        parent = {}
+
+        def find(group):
+            while parent[group] != group:
+                parent[group] = parent[parent[group]]
+                group = parent[group]
+            return group
+
+        for package in packages:
+            if package in owner:
+                continue
+            group = len(parent)
+            parent[group] = group
+            owner[package] = group
+            work = [package]
+            while work:
+                node = work.pop()
+                for child in self._getChildren(node):
+                    if child in self.propagated:
+                        continue
+                    if child in owner:
+                        other = find(owner[child])
+                        if other != find(group):
+                            parent[other] = find(group)
+                        continue
+                    owner[child] = group
+                    work.append(child)
+
+        groups = {}
+        for package in packages:
+            groups.setdefault(find(owner[package]), []).append(package)
+        return list(groups.values())
+
+    def _failingChildren(self, package):
+        return [c for c in self._getChildren(package) if not self.propagated.get(c, 0)]
+
+    def _findOffendingPaths(self, package, failingComponents, sinks):
+        # Shortest paths from the package down to the packages where the
+        # license check starts failing: those which have no usable license
+        # although their own dependencies do. Packages which fail because
+        # of each other count as one, and only the shortest path to one
+        # of them is reported.
+        paths = {}
+        previous = {package: None}
+        work = [package]
+        while work:
+            nextWork = []
+            for node in work:
+                component = id(failingComponents[node])
+                if component in sinks:
+                    if not component in paths:
+                        path = []
+                        while node is not None:
+                            path.append(node)
+                            node = previous[node]
+                        paths[component] = list(reversed(path))
+                    continue
+                for child in self._failingChildren(node):
+                    if not child in previous:
+                        previous[child] = node
+                        nextWork.append(child)
+            work = nextWork
+        return sorted(paths.values())
+
+    def _describeConflict(self, package, component):
+        return {
+            "license": self._getLicenses(package),
+            "dependencies": dict((child, sorted(self.table.licenses(self.propagated.get(child, 0))))
+                                 for child in self._getChildren(package)),
+            # Failing packages which depend on each other.
+            "cycle": sorted(component) if len(component) > 1 else [],
+        }
+
+    # Public API methods: propagate, createTree, testPackage and testPackages.
 
     def propagate(self, node):
         """Propagate licenses for a runtime dependency tree.
@@ -368,6 +882,7 @@ class LicenseCheck():
         parameter.
         """
 
+        self._checkGeneration()
         rundeps = self._getRdeps(package)
 
         licenses = self._parseLicenseString(self._getLicenses(package))
@@ -381,19 +896,143 @@ class LicenseCheck():
         """Test whether a package passes the license check.
 
         Return True if the package in 'package' parameter passes the
-        license check. Return False if the license check fails. This is
-        a helper method using 'createTree' and 'propagate' methods.
+        license check. Return False if the license check fails. The
+        runtime dependencies are treated as a graph, so results for
+        packages shared by several packages are calculated only once
+        and reused in later calls.
         """
 
-        tree = self.createTree(package)
-        if tree:
-            licenses = self.propagate(tree)
-            if licenses:
-                return True
-            else:
-                # did not find a suitable license, print the tree for debugging
-                print("No suitable license found for %s:" % package)
-                tree.printTree()
+        self._checkGeneration()
+        licenses = self._propagatePackage(package)
+        if licenses:
+            return True
         else:
-            print("No such package (%s)" % package)
+            # did not find a suitable license, print the tree for debugging
+            print("No suitable license found for %s:" % package)
+            self._printGraph(package)
         return False
+
+    def testPackages(self, packages, jobs=1):
+        """Test whether a set of packages passes the license check.
+
+        Typically 'packages' are all packages installed in an image.
+        The runtime dependency graph of all packages is evaluated
+        together. Groups of packages which do not share dependencies
+        are evaluated in parallel by up to 'jobs' processes.
+
+        Return a report as dictionary: "failed" maps each package which
+        failed the check to the shortest dependency paths leading to
+        the packages where the check starts failing, and "conflicts"
+        describes those packages (LICENSE value, the usable licenses of
+        their dependencies and the failing packages they form a cycle
+        with).
+        """
+
+        self._checkGeneration()
+        packages = sorted(set(packages))
+        groups = self._findComponentGroups([p for p in packages if not p in self.propagated])
+        if jobs > 1 and len(groups) > 1:
+            # Largest groups first, so that they do not end up last.
+            groups.sort(key=len, reverse=True)
+            # The workers use the package index of this instance instead of
+            # each checking PKGDATA_DIR for changes again.
+            args = (self.whitelistFile, self.prohibited, self.pkgdataDir, self.pkgdataCache, self.pkgdata)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_initWorker,
+                                                        initargs=args) as executor:
+                for result in executor.map(_testPackageGroup, groups):
+                    for package, licenses in result.items():
+                        self.propagated[package] = self.table.mask(licenses)
+        else:
+            for group in groups:
+                for package in group:
+                    self._propagatePackage(package)
+
+        failed = {}
+        conflicts = {}
+        failingComponents = {}
+        sinks = set()
+        for package in packages:
+            if self.propagated[package]:
+                continue
+            if not package in failingComponents:
+                for component in self._findComponents(package, self._failingChildren, failingComponents):
+                    for member in component:
+                        failingComponents[member] = component
+                    if all(failingComponents[c] is component
+                           for member in component for c in self._failingChildren(member)):
+                        sinks.add(id(component))
+            paths = self._findOffendingPaths(package, failingComponents, sinks)
+            failed[package] = paths
+            for path in paths:
+                if not path[-1] in conflicts:
+                    conflicts[path[-1]] = self._describeConflict(path[-1], failingComponents[path[-1]])
+        return {
+            "prohibited": sorted(self.prohibited),
+            "checked": len(packages),
+            "failed": failed,
+            "conflicts": conflicts,
+        }
+
+# The LicenseCheck instance of a worker process of LicenseCheck.testPackages().
+_workerChecker = None
+
+def _initWorker(*args):
+    global _workerChecker
+    _workerChecker = LicenseCheck(*args)
+
+def _testPackageGroup(packages):
+    # Runs in a worker process of LicenseCheck.testPackages(). Returns the
+    # propagated licenses of all packages evaluated for the group, as
+    # license names because the bits are only valid inside the process.
+    checker = _workerChecker
+    known = set(checker.propagated)
+    for package in packages:
+        checker._propagatePackage(package)
+    return dict((package, sorted(checker.table.licenses(licenses)))
+                for package, licenses in checker.propagated.items()
+                if not package in known)
+
+def readManifest(manifestFile, skip=[]):
+    """Read the package names from an image package.manifest.
+
+    Packages starting with one of the prefixes in 'skip' are ignored.
+    """
+
+    packages = []
+    with open(manifestFile) as f:
+        for line in f:
+            name = line.strip()
+            if name and not any(name.startswith(prefix) for prefix in skip):
+                packages.append(name)
+    return packages
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the runtime licenses of the packages in an image.")
+    parser.add_argument("manifest", help="package.manifest of the image")
+    parser.add_argument("-w", "--whitelist", help="file with packages which do not propagate licenses")
+    parser.add_argument("-p", "--prohibited", action="append", default=[], metavar="LICENSE",
+                        help="prohibited license, can be given more than once")
+    parser.add_argument("-d", "--pkgdata-dir", help="PKGDATA_DIR of the build (default: use oe-pkgdata-util)")
+    parser.add_argument("-s", "--skip", action="append", default=[], metavar="PREFIX",
+                        help="ignore packages starting with PREFIX, can be given more than once")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of parallel processes")
+    parser.add_argument("-o", "--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    checker = LicenseCheck(args.whitelist, args.prohibited, args.pkgdata_dir)
+    report = checker.testPackages(readManifest(args.manifest, args.skip), args.jobs)
+    report["manifest"] = os.path.abspath(args.manifest)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+        for package, paths in sorted(report["failed"].items()):
+            print("No suitable license found for %s: %s" % (package, ", ".join([" -> ".join(p) for p in paths])))
+    else:
+        json.dump(report, sys.stdout, indent=4, sort_keys=True)
+        print()
+    return 1 if report["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -36,21 +36,23 @@ computer vision production image without GPLv3 components."""
 from oeqa.selftest.case import OESelftestTestCase
 from oeqa.utils.commands import runCmd, bitbake, get_bb_var, get_bb_vars, runqemu
 import glob
+import os
+import shutil
 import sys
+import tempfile
 sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../../../')
 import licensecheck
 
 class LicensingTest(OESelftestTestCase):
     """Licensing test class."""
 
-    def _analyzePackages(self, packageNames, whitelistFile, prohibited):
-        checker = licensecheck.LicenseCheck(whitelistFile, prohibited)
+    def _analyzePackages(self, packageNames, whitelistFile, prohibited, pkgdataDir=None):
+        checker = licensecheck.LicenseCheck(whitelistFile, prohibited, pkgdataDir)
 
         # Process packages which are installed to the image.
 
+        packages = []
         for name in packageNames:
-            print("Processing package %s..." % name)
-
             # We can safely skip the kernel modules, also works around kernel
             # naming issues.
             if name.startswith("kernel"):
@@ -71,7 +73,74 @@ class LicensingTest(OESelftestTestCase):
             if name.startswith("linux-firmware"):
                 continue
 
-            self.assertTrue(checker.testPackage(name), msg="License check for package %s failed" % name)
+            packages.append(name)
+
+        print("Processing %d packages..." % len(packages))
+        report = checker.testPackages(packages, os.cpu_count() or 1)
+        for name, paths in sorted(report["failed"].items()):
+            print("No suitable license found for %s: %s" % (name, ", ".join([" -> ".join(p) for p in paths])))
+        for name, conflict in sorted(report["conflicts"].items()):
+            print("%s (%s) depends on %s" % (name, conflict["license"], conflict["dependencies"]))
+        self.assertFalse(report["failed"], msg="License check for packages %s failed" % ", ".join(sorted(report["failed"])))
+
+    def _createPkgdata(self, pkgdataDir, packages):
+        # Minimal PKGDATA_DIR with one recipe per package. 'packages' maps
+        # package names to (LICENSE, RDEPENDS).
+        os.makedirs(os.path.join(pkgdataDir, "runtime"))
+        os.makedirs(os.path.join(pkgdataDir, "runtime-reverse"))
+        for name, (license, rdepends) in packages.items():
+            with open(os.path.join(pkgdataDir, "runtime", name), "w") as f:
+                f.write("PN: %s\nPKG_%s: %s\nLICENSE: %s\nRDEPENDS_%s: %s\n" %
+                        (name, name, name, license, name, rdepends))
+            os.symlink(os.path.join("..", "runtime", name),
+                       os.path.join(pkgdataDir, "runtime-reverse", name))
+
+    def test_whitelists_are_separate(self):
+
+        """ Check that license checkers with different whitelists do not
+            share their results.
+        """
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pkgdatadir = os.path.join(tmpdir, "pkgdata")
+            self._createPkgdata(pkgdatadir, {
+                "app": ("MIT", "lib"),
+                "lib": ("GPLv3", ""),
+            })
+            whitelist = os.path.join(tmpdir, "whitelist.txt")
+            with open(whitelist, "w") as f:
+                f.write("lib\n")
+            prohibited = ["GPLv3"]
+
+            strict = licensecheck.LicenseCheck(None, prohibited, pkgdatadir)
+            self.assertFalse(strict.testPackage("app"), msg="GPLv3 dependency not detected")
+            relaxed = licensecheck.LicenseCheck(whitelist, prohibited, pkgdatadir)
+            self.assertTrue(relaxed.testPackage("app"), msg="Whitelisted GPLv3 dependency not ignored")
+            self.assertFalse(strict.testPackage("app"), msg="GPLv3 dependency no longer detected")
+
+    def test_rebuilt_packages(self):
+
+        """ Check that existing license checkers notice packages which were
+            rebuilt after they were created.
+        """
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pkgdatadir = os.path.join(tmpdir, "pkgdata")
+            self._createPkgdata(pkgdatadir, {
+                "app": ("MIT", "lib (>= 1.0)"),
+                "lib": ("MIT", ""),
+            })
+            prohibited = ["GPLv3"]
+
+            checker = licensecheck.LicenseCheck(None, prohibited, pkgdatadir)
+            self.assertTrue(checker.testPackage("app"), msg="MIT packages failed the check")
+            shutil.rmtree(pkgdatadir)
+            self._createPkgdata(pkgdatadir, {
+                "app": ("MIT", "lib (>= 1.0)"),
+                "lib": ("GPLv3", ""),
+            })
+            licensecheck.LicenseCheck(None, prohibited, pkgdatadir)
+            self.assertFalse(checker.testPackage("app"), msg="Rebuilt GPLv3 dependency not detected")
 
     def _get_latest_manifest(self, imagename, deploydir):
         # A hack for finding the correct package.manifest for the image we just
@@ -102,11 +171,12 @@ class LicensingTest(OESelftestTestCase):
         print('Building test image (%s)...' % test_image)
 
         # Get variables from BB and initialize package list.
-        bb_vars = get_bb_vars(["DEPLOY_DIR", "IMAGE_NAME", "META_REFKIT_BASE", "META_REFKIT_CORE_BASE"], test_image)
+        bb_vars = get_bb_vars(["DEPLOY_DIR", "IMAGE_NAME", "META_REFKIT_BASE", "META_REFKIT_CORE_BASE", "PKGDATA_DIR"], test_image)
         deploydir = bb_vars["DEPLOY_DIR"]
         imagename = bb_vars["IMAGE_NAME"]
         basedir = bb_vars["META_REFKIT_BASE"]
         coredir = bb_vars["META_REFKIT_CORE_BASE"]
+        pkgdatadir = bb_vars["PKGDATA_DIR"]
 
         self.append_config('IMAGE_MODE="production"')
         self.append_config('IMAGE_MODE_SUFFIX="-production"')
@@ -135,4 +205,4 @@ class LicensingTest(OESelftestTestCase):
         # GPLv3 and LGPLv3 are not allowed in this image.
         prohibited=["GPLv3", "LGPLv3"]
 
-        self._analyzePackages(packageNames, whitelist, prohibited)
+        self._analyzePackages(packageNames, whitelist, prohibited, pkgdatadir)
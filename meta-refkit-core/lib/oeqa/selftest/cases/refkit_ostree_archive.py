@@ -0,0 +1,75 @@
+from oeqa.selftest.case import OESelftestTestCase
+from oeqa.utils.commands import runCmd, bitbake, get_bb_var
+
+import glob
+import os
+import struct
+import sys
+import tempfile
+import zlib
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/../../../')
+from ostree import archive
+
+class RefkitOSTreeArchiveTest(OESelftestTestCase):
+    """
+    Compares the archive-z2 objects written by ostree.archive, which get
+    added to OSTREE_REPO instead of letting pull-local compress them,
+    with the ones written by OSTree itself.
+    """
+
+    def ostree(self, args):
+        return runCmd('%s %s' % (self.ostree_bin, args), output_log=self.logger)
+
+    def setUp(self):
+        super().setUp()
+        self.ostree_bin = os.path.join(get_bb_var('RECIPE_SYSROOT_NATIVE', 'ostree-native'), 'usr', 'bin', 'ostree')
+        if not os.path.exists(self.ostree_bin):
+            bitbake('ostree-native:do_addto_recipe_sysroot', output_log=self.logger)
+        self.assertExists(self.ostree_bin, 'ostree-native was not built as expected')
+
+    def test_write_object(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tree = os.path.join(tmpdir, 'tree')
+            os.mkdir(tree)
+            with open(os.path.join(tree, 'regular'), 'w') as f:
+                f.write('hello world\n' * 1000)
+            os.symlink('regular', os.path.join(tree, 'symlink'))
+            xattr = os.path.join(tree, 'xattr')
+            with open(xattr, 'w') as f:
+                f.write('extended attributes\n')
+            os.chmod(xattr, 0o755)
+            try:
+                os.setxattr(xattr, 'user.refkit', b'value')
+            except OSError as ex:
+                self.skipTest('%s does not support extended attributes: %s' % (tmpdir, ex))
+
+            bare = os.path.join(tmpdir, 'bare')
+            repo = os.path.join(tmpdir, 'archive')
+            self.ostree('--repo=%s init --mode=bare' % bare)
+            self.ostree('--repo=%s commit --branch=test %s' % (bare, tree))
+            self.ostree('--repo=%s init --mode=archive-z2' % repo)
+            self.ostree('--repo=%s pull-local %s test' % (repo, bare))
+
+            # The compressed content depends on the zlib build, so compare
+            # the file headers and the uncompressed content. Then replace
+            # the objects written by ostree and let it check them.
+            objects = glob.glob(os.path.join(bare, 'objects', '*', '*.file'))
+            self.assertEqual(len(objects), 3)
+            for src in objects:
+                name = os.path.relpath(src, os.path.join(bare, 'objects')) + 'z'
+                dst = os.path.join(repo, 'objects', name)
+                expected_header, expected_content = self.read_object(dst)
+                archive.write_object(src, dst)
+                header, content = self.read_object(dst)
+                self.assertEqual(header, expected_header, 'file header of %s differs from the one written by ostree' % name)
+                self.assertEqual(content, expected_content, 'content of %s differs from the one written by ostree' % name)
+                self.assertEqual(archive.checksum_object(dst), name.replace('/', '')[:-len('.filez')])
+            self.ostree('--repo=%s fsck' % repo)
+
+    def read_object(self, path):
+        # Returns the length-prefixed file header and the uncompressed
+        # content of an archive-z2 object.
+        with open(path, 'rb') as f:
+            data = f.read()
+        size = 8 + struct.unpack('>I', data[:4])[0]
+        return data[:size], zlib.decompress(data[size:], -zlib.MAX_WBITS) if len(data) > size else b''
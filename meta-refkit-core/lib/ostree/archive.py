@@ -0,0 +1,177 @@
+"""
+Writing content objects in the format used by archive-z2 OSTree
+repositories, without going through ostree itself. Used to compress
+the objects of a bare repository in parallel ahead of publishing.
+
+An archive-z2 content object (objects/xx/yyy.filez) consists of:
+- the size of the file header as 32-bit big-endian integer,
+- four bytes of padding,
+- the file header, a GVariant of type (tuuuusa(ayay)) with size, uid,
+  gid, mode, rdev, symlink target and extended attributes, the numbers
+  stored big-endian; the size is that of the content and thus 0 for
+  symlinks,
+- for regular files, the content as raw deflate stream.
+
+The name of the object is its content checksum: the SHA256 of the
+length-prefixed (uuuusa(ayay)) file header without the size, followed
+by the uncompressed content. checksum_object() recomputes it, so that
+objects written here can be verified before they get added to a
+repository.
+
+The GVariant is serialized directly, in the little-endian byte order
+that OSTree produces on the hosts we build on.
+"""
+
+import hashlib
+import os
+import stat
+import struct
+import zlib
+
+# Same as OSTREE_ARCHIVE_DEFAULT_COMPRESSION_LEVEL.
+COMPRESSION_LEVEL = 6
+
+# Amount of data compressed at once.
+CHUNK_SIZE = 1024 * 1024
+
+def _offset_size(body_size, offsets):
+    """
+    Size of the framing offsets of a GVariant container, which depends
+    on the total size of the container including the offsets.
+    """
+    for size in (1, 2, 4):
+        if body_size + size * offsets < 1 << (size * 8):
+            return size
+    return 8
+
+def _container(members, array):
+    """
+    Serialize a GVariant tuple or array of byte-aligned, variable-sized
+    members. Arrays store the end offsets of all members in order, tuples
+    those of all members except the last one in reverse order.
+    Returns the serialized data.
+    """
+    body = b''
+    ends = []
+    for member in members:
+        body += member
+        ends.append(len(body))
+    if not array:
+        ends = list(reversed(ends[:-1]))
+    size = _offset_size(len(body), len(ends))
+    return body + b''.join(end.to_bytes(size, 'little') for end in ends)
+
+def _xattrs(xattrs):
+    """
+    Serialize an a(ayay) array of (name, value) pairs. The names are
+    stored with a trailing nul byte, like g_variant_new_bytestring() does.
+    """
+    elements = [_container((name + b'\0', value), False) for name, value in xattrs]
+    return _container(elements, True) if elements else b''
+
+def _length_prefixed(header):
+    return struct.pack('>I', len(header)) + b'\0' * 4 + header
+
+def file_header(st, symlink_target, xattrs):
+    """
+    Return the length-prefixed file header for a file with the given
+    lstat() result, symlink target ('' for regular files) and list of
+    (name, value) extended attributes.
+    """
+    # OSTree only records a size for regular files, see
+    # _ostree_stbuf_to_gfileinfo().
+    size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+    fixed = struct.pack('>QIIII', size, st.st_uid, st.st_gid, st.st_mode, 0)
+    header = _container((fixed + symlink_target.encode('utf-8', errors='surrogateescape') + b'\0',
+                         _xattrs(xattrs)),
+                        False)
+    return _length_prefixed(header)
+
+def _parse_file_header(header):
+    """
+    Split a serialized (tuuuusa(ayay)) file header into the size, the
+    packed uid, gid, mode and rdev, the nul-terminated symlink target and
+    the serialized extended attributes.
+    """
+    # The size of the framing offset follows from the size of the header.
+    size = 4 if len(header) > 0xffff else 2 if len(header) > 0xff else 1
+    if len(header) < 24 + size:
+        raise ValueError('truncated file header')
+    end = int.from_bytes(header[-size:], 'little')
+    if not 24 < end <= len(header) - size or header[end - 1] != 0:
+        raise ValueError('invalid symlink target in file header')
+    return (struct.unpack('>Q', header[:8])[0], header[8:24],
+            header[24:end], header[end:-size])
+
+def checksum_object(path):
+    """
+    Compute the content checksum of the archive-z2 object in 'path',
+    which is also the name under which it has to be stored. Raises
+    ValueError when the object is malformed.
+    """
+    with open(path, 'rb') as f:
+        prefix = f.read(8)
+        if len(prefix) != 8:
+            raise ValueError('truncated object')
+        header = f.read(struct.unpack('>I', prefix[:4])[0])
+        size, fixed, symlink_target, xattrs = _parse_file_header(header)
+        checksum = hashlib.sha256(_length_prefixed(_container((fixed + symlink_target, xattrs), False)))
+        mode = struct.unpack('>I', fixed[8:12])[0]
+        if stat.S_ISREG(mode):
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            content_size = 0
+            try:
+                while True:
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    data = decompressor.decompress(data)
+                    content_size += len(data)
+                    checksum.update(data)
+                data = decompressor.flush()
+            except zlib.error as ex:
+                raise ValueError('invalid content: %s' % ex)
+            content_size += len(data)
+            checksum.update(data)
+            if not decompressor.eof or decompressor.unused_data:
+                raise ValueError('invalid content')
+            if content_size != size:
+                raise ValueError('content size %d does not match file header (%d)' % (content_size, size))
+        elif f.read(1):
+            raise ValueError('unexpected content')
+    return checksum.hexdigest()
+
+def get_xattrs(path):
+    """
+    Return the extended attributes of a file as list of (name, value).
+    """
+    return [(name.encode('utf-8', errors='surrogateescape'), os.getxattr(path, name, follow_symlinks=False))
+            for name in os.listxattr(path, follow_symlinks=False)]
+
+def write_object(src, dst, level=COMPRESSION_LEVEL):
+    """
+    Write the archive-z2 object for the bare repository object in 'src'
+    (a regular file or symlink with real ownership, permissions and
+    extended attributes) to 'dst'. The file is written under a temporary
+    name and renamed, so 'dst' is either complete or missing. Returns
+    the size of the written object.
+    """
+    st = os.lstat(src)
+    tmp = dst + '.tmp'
+    with open(tmp, 'wb') as f:
+        if stat.S_ISLNK(st.st_mode):
+            f.write(file_header(st, os.readlink(src), get_xattrs(src)))
+        else:
+            f.write(file_header(st, '', get_xattrs(src)))
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            with open(src, 'rb') as fsrc:
+                while True:
+                    data = fsrc.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(compressor.compress(data))
+            f.write(compressor.flush())
+        size = f.tell()
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, dst)
+    return size
@@ -0,0 +1,114 @@
+"""
+In-process access to libostree through GObject introspection. Used by
+OSTreeUpdate instead of running the ostree command line tool for the
+most common operations when OSTREE_BACKEND = "libostree".
+
+Only the typelib and library from ostree-native are used, never those
+of the build host, so that the repositories get written by the same
+libostree as with the ostree command. Creating a LibOSTree fails with
+ImportError when they are not available.
+"""
+
+import os.path
+
+import gi
+gi.require_version('GIRepository', '2.0')
+from gi.repository import GIRepository, Gio, GLib
+
+# Errors reported by the methods below.
+ERRORS = (GLib.Error,)
+
+# The OSTree namespace, once loaded by load().
+OSTree = None
+
+def load(libdir):
+    """
+    Load the OSTree namespace from the native sysroot library directory
+    (STAGING_LIBDIR_NATIVE).
+    """
+    global OSTree
+    typelib = os.path.join(libdir, 'girepository-1.0', 'OSTree-1.0.typelib')
+    if not os.path.isfile(typelib):
+        raise ImportError('%s not found, ostree-native was built without GObject introspection' % typelib)
+    repository = GIRepository.Repository.get_default()
+    repository.prepend_search_path(os.path.dirname(typelib))
+    repository.prepend_library_path(libdir)
+    gi.require_version('OSTree', '1.0')
+    from gi.repository import OSTree as namespace
+    loaded = repository.get_typelib_path('OSTree')
+    if not loaded or os.path.realpath(loaded) != os.path.realpath(typelib):
+        # Loaded from somewhere else before the search path was set.
+        raise ImportError('OSTree typelib loaded from %s instead of %s' % (loaded, typelib))
+    OSTree = namespace
+
+class LibOSTree(object):
+    """
+    Keeps one OSTree.Repo handle per repository open, so that consecutive
+    operations on the same repository do not have to open it again.
+    """
+
+    def __init__(self, libdir):
+        load(libdir)
+        self.modes = {
+            'bare': OSTree.RepoMode.BARE,
+            'bare-user': OSTree.RepoMode.BARE_USER,
+            'archive-z2': OSTree.RepoMode.ARCHIVE_Z2,
+        }
+        self.repos = {}
+
+    def open_repo(self, path):
+        repo = self.repos.get(path)
+        if repo is None:
+            repo = OSTree.Repo.new(Gio.File.new_for_path(path))
+            repo.open(None)
+            self.repos[path] = repo
+        return repo
+
+    def init(self, path, mode):
+        repo = OSTree.Repo.new(Gio.File.new_for_path(path))
+        repo.create(self.modes[mode], None)
+        self.repos[path] = repo
+
+    def commit(self, path, branch, subject, tree_dir=None, tree_ref=None,
+               gpg_id=None, gpg_homedir=None):
+        """
+        Equivalent of "ostree commit" with either --tree=dir or --tree=ref.
+        Returns the checksum of the new commit.
+        """
+        repo = self.open_repo(path)
+        repo.prepare_transaction(None)
+        try:
+            if tree_ref:
+                _, root, _ = repo.read_commit(tree_ref, None)
+            else:
+                mtree = OSTree.MutableTree.new()
+                modifier = OSTree.RepoCommitModifier.new(OSTree.RepoCommitModifierFlags.NONE, None)
+                repo.write_directory_to_mtree(Gio.File.new_for_path(tree_dir), mtree, modifier, None)
+                _, root = repo.write_mtree(mtree, None)
+            _, parent = repo.resolve_rev(branch, True)
+            _, checksum = repo.write_commit(parent, subject or '', None, None, root, None)
+            if gpg_id:
+                repo.sign_commit(checksum, gpg_id, gpg_homedir or None, None)
+            repo.transaction_set_ref(None, branch, checksum)
+            repo.commit_transaction(None)
+        except:
+            repo.abort_transaction(None)
+            raise
+        return checksum
+
+    def summary(self, path, gpg_id=None, gpg_homedir=None):
+        repo = self.open_repo(path)
+        repo.regenerate_summary(None, None)
+        if gpg_id:
+            repo.add_gpg_signature_summary([gpg_id], gpg_homedir or None, None)
+
+    def pull_local(self, path, src, remote, branch):
+        """
+        Equivalent of "ostree pull-local --remote=<remote> <src> <branch>".
+        """
+        repo = self.open_repo(path)
+        options = GLib.Variant('a{sv}', {
+            'refs': GLib.Variant('as', [branch]),
+            'override-remote-name': GLib.Variant('s', remote),
+        })
+        repo.pull_with_options('file://' + os.path.abspath(src), options, None, None)
@@ -1,31 +1,46 @@
 import bb
 import oe.path
 
+from ostree import archive
+
+import base64
+import concurrent.futures
+import contextlib
+import errno
 import glob
 import hashlib
+import json
 import os.path
+import re
 import shutil
 import string
 import subprocess
+import time
 
 VARIABLES = (
     'IMAGE_ROOTFS',
+    'OSTREE_ARCHIVE_STAGING',
+    'OSTREE_BACKEND',
     'OSTREE_BRANCHNAME',
     'OSTREE_COMMIT_SUBJECT',
+    'OSTREE_DELTAS',
     'OSTREE_REPO',
     'OSTREE_GPGDIR',
     'OSTREE_GPGID',
     'OSTREE_OS',
     'OSTREE_REMOTE',
     'OSTREE_BARE',
+    'OSTREE_BARE_INCREMENTAL',
+    'OSTREE_BARE_MODE',
     'OSTREE_ROOTFS',
     'OSTREE_SYSROOT',
+    'STAGING_LIBDIR_NATIVE',
 )
 
 class OSTreeUpdate(string.Formatter):
     """
     Create an OSTree-enabled version of an image rootfs, using an intermediate
-    per-image OSTree bare-user repository. Optionally export the content
+    per-image OSTree bare or bare-user repository. Optionally export the content
     of this repository into HTTP-exportable archive-z2 OSTree repository
     which clients can use to pull the image in as an OSTree upgrade.
     """
@@ -49,6 +64,18 @@ class OSTreeUpdate(string.Formatter):
                 self.gpg_sign += self.format(' --gpg-homedir={OSTREE_GPGDIR}')
             self.gpg_sign += self.format(' --gpg-sign={OSTREE_GPGID}')
 
+        self.libostree = None
+        self.errors = (subprocess.CalledProcessError,)
+        if self.OSTREE_BACKEND == 'libostree':
+            try:
+                from ostree import libostree
+                self.libostree = libostree.LibOSTree(self.STAGING_LIBDIR_NATIVE)
+                self.errors += libostree.ERRORS
+            except (ImportError, ValueError) as ex:
+                bb.warn('libostree is not usable, falling back to the ostree command: %s' % ex)
+        elif self.OSTREE_BACKEND != 'cli':
+            bb.fatal('OSTREE_BACKEND=%s, must be "cli" or "libostree"' % self.OSTREE_BACKEND)
+
     def get_value(self, key, args, kwargs):
         """
         This class inherits string.Formatter and thus has self.format().
@@ -67,6 +94,67 @@ class OSTreeUpdate(string.Formatter):
         output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
         return output
 
+    @contextlib.contextmanager
+    def timed(self, step, *args, **kwargs):
+        """
+        Report how long the code inside the with statement took.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            bb.note('%s took %.1fs.' % (self.format(step, *args, **kwargs), time.time() - start))
+
+    # The following methods run the ostree operations which have an
+    # in-process equivalent, using libostree when enabled and the ostree
+    # command otherwise. Deploying always uses the ostree command, which
+    # also merges /etc and the origin of the previous deployment, locks
+    # the sysroot and cleans up afterwards.
+
+    def ostree_init(self, repo, mode):
+        with self.timed('Initializing {0}', repo):
+            if self.libostree:
+                self.libostree.init(repo, mode)
+            else:
+                self.run_ostree('--repo={0} init --mode={1}', repo, mode)
+
+    def ostree_commit(self, repo, subject=None, tree_dir=None, tree_ref=None):
+        with self.timed('Committing to {0}', repo):
+            if self.libostree:
+                self.libostree.commit(repo, self.OSTREE_BRANCHNAME, subject,
+                                      tree_dir=tree_dir, tree_ref=tree_ref,
+                                      gpg_id=self.OSTREE_GPGID, gpg_homedir=self.OSTREE_GPGDIR)
+            else:
+                self.run_ostree('--repo={0} commit '
+                                '{gpg_sign} '
+                                '{1} '
+                                '--branch={OSTREE_BRANCHNAME}'
+                                '{2}',
+                                repo,
+                                '--tree=dir=' + tree_dir if tree_dir else '--tree=ref=' + tree_ref,
+                                ' --subject="%s"' % subject if subject else '')
+
+    def ostree_summary(self, repo, sign):
+        with self.timed('Updating summary of {0}', repo):
+            if self.libostree:
+                self.libostree.summary(repo,
+                                       gpg_id=self.OSTREE_GPGID if sign else None,
+                                       gpg_homedir=self.OSTREE_GPGDIR)
+                return ''
+            else:
+                return self.run_ostree('--repo={0} summary {1} -u', repo, self.gpg_sign if sign else '').decode('utf-8')
+
+    def ostree_pull_local(self, repo, src, remote):
+        with self.timed('Pulling {OSTREE_BRANCHNAME} from {0} into {1}', src, repo):
+            if self.libostree:
+                self.libostree.pull_local(repo, src, remote, self.OSTREE_BRANCHNAME)
+            else:
+                self.run_ostree('--repo={0} pull-local --remote={1} {2} {OSTREE_BRANCHNAME}', repo, remote, src)
+
+    def ostree_deploy(self, refspec):
+        with self.timed('Deploying {0} in {OSTREE_ROOTFS}', refspec):
+            self.run_ostree('admin --sysroot={OSTREE_ROOTFS} deploy --os={OSTREE_OS} {0}', refspec)
+
     def copy_sysroot(self):
         """
         Seed the OSTree sysroot with the pristine one.
@@ -74,6 +162,9 @@ class OSTreeUpdate(string.Formatter):
         bb.note(self.format('Copying pristine rootfs {IMAGE_ROOTFS} to OSTree sysroot {OSTREE_SYSROOT} ...'))
         oe.path.copyhardlinktree(self.IMAGE_ROOTFS, self.OSTREE_SYSROOT)
 
+    # Block size for reading and writing the UEFI combo apps.
+    COPY_CHUNK_SIZE = 1024 * 1024
+
     def copy_kernel(self):
         """
         Copy and checksum kernel, initramfs, and the UEFI app in place for OSTree.
@@ -92,21 +183,38 @@ class OSTreeUpdate(string.Formatter):
         bb.note(self.format('Copying and checksumming UEFI combo app(s) {0} into OSTree sysroot {1} ...', uefiappname, ostreeboot))
         bb.utils.mkdirhier(ostreeboot)
         def copy_app(src, dst):
-            with open(src, 'rb') as f:
-                data = f.read()
-                chksum = hashlib.sha256(data).hexdigest()
-            with open(dst + '-' + chksum, 'wb') as f:
-                f.write(data)
-            shutil.copystat(src, dst + '-' + chksum)
+            # Hash while copying, one chunk at a time, so that large apps
+            # with an embedded initramfs never have to be kept in memory.
+            # The final name depends on the checksum, so copy to a
+            # temporary file first.
+            chksum = hashlib.sha256()
+            with open(src, 'rb') as fsrc, open(dst + '.tmp', 'wb') as fdst:
+                while True:
+                    data = fsrc.read(self.COPY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    chksum.update(data)
+                    fdst.write(data)
+            chksum = chksum.hexdigest()
+            shutil.copystat(src, dst + '.tmp')
+            os.rename(dst + '.tmp', dst + '-' + chksum)
             return chksum
 
         # OSTree doesn't care too much about the actual checksums on kernel
         # and initramfs. We use the same checksum derived from the UEFI combo
         # app for all parts related to it.
-        chksum = copy_app(os.path.join(uefibootdir, uefiappname),
-                          os.path.join(ostreeboot, uefiappname + '.ext'))
-        copy_app(os.path.join(uefiinternalbootdir, uefiappname),
-                 os.path.join(ostreeboot, uefiappname + '.int'))
+        #
+        # The external and internal app are independent, so copy both at
+        # the same time (file IO and hashing release the GIL).
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            ext = executor.submit(copy_app,
+                                  os.path.join(uefibootdir, uefiappname),
+                                  os.path.join(ostreeboot, uefiappname + '.ext'))
+            internal = executor.submit(copy_app,
+                                       os.path.join(uefiinternalbootdir, uefiappname),
+                                       os.path.join(ostreeboot, uefiappname + '.int'))
+            chksum = ext.result()
+            internal.result()
 
         # OSTree expects to find kernel and initramfs, so we provide it
         # although the files are not used.
@@ -202,22 +310,99 @@ class OSTreeUpdate(string.Formatter):
         self.copy_kernel()
         self.ostreeify_sysroot()
 
-    def populate_repo(self):
+    # Timing of earlier commits into OSTREE_BARE, stored inside the repo.
+    COMMIT_STATS = 'refkit-commit-stats.json'
+
+    def get_repo_mode(self, repo):
         """
-        Populate primary OSTree repository (bare-user mode) with the given sysroot.
+        Return the mode of an existing repository, None if unknown.
+        """
+        try:
+            with open(os.path.join(repo, 'config')) as f:
+                for line in f:
+                    key, sep, value = line.partition('=')
+                    if key.strip() == 'mode':
+                        return value.strip()
+        except OSError:
+            pass
+        return None
+
+    def init_repo(self):
+        """
+        Create an empty primary OSTree repository, removing any previous one.
         """
-        bb.note(self.format('Populating OSTree primary repository {OSTREE_BARE} ...'))
-
         if os.path.isdir(self.OSTREE_BARE):
             shutil.rmtree(self.OSTREE_BARE)
         bb.utils.mkdirhier(self.OSTREE_BARE)
-        self.run_ostree('--repo={OSTREE_BARE} init --mode=bare-user')
-        self.run_ostree('--repo={OSTREE_BARE} commit '
-                         '{gpg_sign} '
-                         '--tree=dir={OSTREE_SYSROOT} '
-                         '--branch={OSTREE_BRANCHNAME} '
-                         '--subject="{OSTREE_COMMIT_SUBJECT}"')
-        output = self.run_ostree('--repo={OSTREE_BARE} summary -u')
+        self.ostree_init(self.OSTREE_BARE, self.OSTREE_BARE_MODE)
+
+    def commit_repo(self):
+        """
+        Commit the sysroot to the primary OSTree repository on top of the
+        previous commit in the branch (if any) and return the time it took.
+        """
+        start = time.time()
+        self.ostree_commit(self.OSTREE_BARE,
+                           subject=self.OSTREE_COMMIT_SUBJECT,
+                           tree_dir=self.OSTREE_SYSROOT)
+        return time.time() - start
+
+    def prune_repo(self):
+        """
+        Remove refs other than our branch and all objects not needed
+        by the most recent commit from the primary OSTree repository.
+        """
+        refs = self.run_ostree('--repo={OSTREE_BARE} refs').decode('utf-8').split()
+        for ref in refs:
+            if ref != self.OSTREE_BRANCHNAME:
+                bb.note(self.format('Removing stale ref {0} from {OSTREE_BARE} ...', ref))
+                self.run_ostree('--repo={OSTREE_BARE} refs --delete {0}', ref)
+        output = self.run_ostree('--repo={OSTREE_BARE} prune --refs-only --depth=0')
+        bb.note(self.format('Pruned OSTree primary repository {OSTREE_BARE}:\n{0}', output.decode('utf-8')))
+
+    def populate_repo(self):
+        """
+        Populate primary OSTree repository (OSTREE_BARE_MODE) with the given sysroot.
+
+        With OSTREE_BARE_INCREMENTAL enabled, the repository from the previous
+        build is kept and the new commit only needs to store objects which
+        changed.
+        """
+        bb.note(self.format('Populating OSTree primary repository {OSTREE_BARE} ...'))
+
+        statsfile = os.path.join(self.OSTREE_BARE, self.COMMIT_STATS)
+        stats = {}
+        incremental = self.OSTREE_BARE_INCREMENTAL == '1' and \
+                      self.get_repo_mode(self.OSTREE_BARE) == self.OSTREE_BARE_MODE
+        if incremental:
+            try:
+                with open(statsfile) as f:
+                    stats = json.load(f)
+            except (OSError, ValueError):
+                pass
+            bb.note(self.format('Committing on top of the existing content of {OSTREE_BARE} ...'))
+            try:
+                elapsed = self.commit_repo()
+                self.prune_repo()
+            except self.errors as ex:
+                if isinstance(ex, subprocess.CalledProcessError):
+                    ex = ex.output.decode('utf-8', errors='replace')
+                bb.warn(self.format('Incremental commit into {OSTREE_BARE} failed, starting from scratch: {0}', ex))
+                incremental = False
+        if not incremental:
+            self.init_repo()
+            elapsed = self.commit_repo()
+            stats['full'] = elapsed
+
+        if incremental and 'full' in stats:
+            bb.note('OSTree commit took %.1fs instead of %.1fs for a full commit, saved %.1fs.' %
+                    (elapsed, stats['full'], stats['full'] - elapsed))
+        else:
+            bb.note('OSTree commit took %.1fs.' % elapsed)
+        with open(statsfile, 'w') as f:
+            json.dump(stats, f)
+
+        output = self.ostree_summary(self.OSTREE_BARE, False)
         bb.note(self.format('OSTree primary repository {OSTREE_BARE} summary:\n{0}', output))
 
 
@@ -233,13 +418,25 @@ class OSTreeUpdate(string.Formatter):
         self.run_ostree('admin --sysroot={OSTREE_ROOTFS} init-fs {OSTREE_ROOTFS}')
         self.run_ostree('admin --sysroot={OSTREE_ROOTFS} os-init {OSTREE_OS}')
 
+        # When both repositories have the same mode and are on the same
+        # filesystem, pull-local hardlinks the objects instead of copying
+        # them, and the deployment is a hardlink checkout of those. The
+        # sysroot repo is always in bare mode, so this only works with a
+        # bare primary repository. Otherwise the objects get copied.
         bb.note(self.format('Replicating primary OSTree repository {OSTREE_BARE} branch {OSTREE_BRANCHNAME} into OSTree rootfs {OSTREE_ROOTFS} ...'))
-        self.run_ostree('--repo={OSTREE_ROOTFS}/ostree/repo pull-local --remote=updates {OSTREE_BARE} {OSTREE_BRANCHNAME}')
+        start = time.time()
+        self.ostree_pull_local(os.path.join(self.OSTREE_ROOTFS, 'ostree', 'repo'), self.OSTREE_BARE, 'updates')
+        linked, copied, size = self.count_shared_objects(os.path.join(self.OSTREE_ROOTFS, 'ostree', 'repo'))
+        bb.note('Replicated repository in %.1fs: %d objects shared with the primary repository, %d objects (%d KiB) copied.' %
+                (time.time() - start, linked, copied, size // 1024))
 
         bb.note('Deploying sysroot from OSTree sysroot repository...')
-        self.run_ostree('admin --sysroot={OSTREE_ROOTFS} deploy --os={OSTREE_OS} updates:{OSTREE_BRANCHNAME}')
+        self.ostree_deploy(self.format('updates:{OSTREE_BRANCHNAME}'))
 
         # OSTree initialized var for our OS, but we want the original rootfs content instead.
+        # Removing what os-init created only removes a few empty directories, and
+        # copyhardlinktree() hardlinks the files when IMAGE_ROOTFS is on the same
+        # filesystem, so no file content gets copied here either.
         src = os.path.join(self.IMAGE_ROOTFS, 'var')
         dst = os.path.join(self.OSTREE_ROOTFS, 'ostree', 'deploy', self.OSTREE_OS, 'var')
         bb.note(self.format('Copying /var from rootfs to OSTree rootfs as {} ...', dst))
@@ -253,6 +450,31 @@ class OSTreeUpdate(string.Formatter):
                              'updates {OSTREE_REMOTE}')
 
 
+    def count_shared_objects(self, repo):
+        """
+        Count the content objects in a repository which are hardlinks of
+        the same objects in the primary repository, and the number and
+        total size of the others.
+        """
+        linked = copied = size = 0
+        objects = os.path.join(repo, 'objects')
+        for root, dirs, filenames in os.walk(objects):
+            for filename in filenames:
+                if not filename.endswith('.file'):
+                    continue
+                path = os.path.join(root, filename)
+                st = os.lstat(path)
+                try:
+                    primary = os.lstat(os.path.join(self.OSTREE_BARE, 'objects', os.path.relpath(path, objects)))
+                except OSError:
+                    primary = None
+                if primary and (primary.st_dev, primary.st_ino) == (st.st_dev, st.st_ino):
+                    linked += 1
+                else:
+                    copied += 1
+                    size += st.st_size
+        return linked, copied, size
+
     def finalize_sysroot(self):
         """
         Finalize the physical root directory after the ostree checkout.
@@ -270,10 +492,17 @@ class OSTreeUpdate(string.Formatter):
         Create the intermediate, bare repo and a fully functional rootfs for the target device
         where the current build is deployed.
         """
-        self.prepare_sysroot()
-        self.populate_repo()
-        self.checkout_sysroot()
-        self.finalize_sysroot()
+        with self.timed('Preparing OSTree sysroot'):
+            self.prepare_sysroot()
+        with self.timed('Populating OSTree primary repository'):
+            self.populate_repo()
+        if self.OSTREE_REPO and self.OSTREE_ARCHIVE_STAGING:
+            with self.timed('Staging archive-z2 objects'):
+                self.stage_archive_objects()
+        with self.timed('Checking out OSTree rootfs'):
+            self.checkout_sysroot()
+        with self.timed('Finalizing OSTree rootfs'):
+            self.finalize_sysroot()
 
 
     def export_repo(self):
@@ -285,8 +514,172 @@ class OSTreeUpdate(string.Formatter):
         if not os.path.isdir(self.OSTREE_REPO):
             bb.note("Initializing repository %s for exporting..." % self.OSTREE_REPO)
             bb.utils.mkdirhier(self.OSTREE_REPO)
-            self.run_ostree('--repo={OSTREE_REPO} init --mode=archive-z2')
+            self.ostree_init(self.OSTREE_REPO, 'archive-z2')
+
+        if self.OSTREE_ARCHIVE_STAGING:
+            self.link_staged_objects()
+        self.ostree_pull_local(self.OSTREE_REPO, self.OSTREE_BARE, self.OSTREE_OS)
+        self.ostree_commit(self.OSTREE_REPO, tree_ref=self.format('{OSTREE_OS}:{OSTREE_BRANCHNAME}'))
+        with self.timed('Generating static deltas'):
+            self.generate_deltas()
+        # The summary lists the available deltas, so it has to come last.
+        self.ostree_summary(self.OSTREE_REPO, True)
+
+    def stage_archive_objects(self):
+        """
+        Compress the content objects of the primary repository into the
+        archive-z2 format in OSTREE_ARCHIVE_STAGING, in parallel. Objects
+        are content-addressed, so anything staged by a previous build
+        stays valid and only new objects need to be compressed. Staged
+        objects which are no longer in the primary repository get removed.
+
+        Only works with a bare primary repository, because the ownership,
+        permissions and extended attributes of the objects are taken from
+        the files themselves.
+        """
+        if self.get_repo_mode(self.OSTREE_BARE) != 'bare':
+            bb.note(self.format('{OSTREE_BARE} is not a bare repository, not staging archive-z2 objects.'))
+            return
+
+        objects = os.path.join(self.OSTREE_BARE, 'objects')
+        pending = []
+        wanted = set()
+        for root, dirs, filenames in os.walk(objects):
+            for filename in filenames:
+                if not filename.endswith('.file'):
+                    continue
+                path = os.path.join(self.OSTREE_ARCHIVE_STAGING, os.path.relpath(os.path.join(root, filename), objects) + 'z')
+                wanted.add(path)
+                if not os.path.exists(path):
+                    pending.append((os.path.join(root, filename), path))
+
+        removed = 0
+        for root, dirs, filenames in os.walk(self.OSTREE_ARCHIVE_STAGING):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if path not in wanted:
+                    os.unlink(path)
+                    removed += 1
+
+        def stage(paths):
+            src, dst = paths
+            bb.utils.mkdirhier(os.path.dirname(dst))
+            return os.lstat(src).st_size, archive.write_object(src, dst)
+
+        # zlib releases the GIL while compressing, so threads are enough.
+        start = time.time()
+        size = compressed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            for src_size, dst_size in executor.map(stage, pending):
+                size += src_size
+                compressed += dst_size
+        bb.note('Staged %d new archive-z2 objects (%d KiB -> %d KiB) in %.1fs, %d already staged, %d removed.' %
+                (len(pending), size // 1024, compressed // 1024, time.time() - start, len(wanted) - len(pending), removed))
+
+    def link_staged_objects(self):
+        """
+        Hardlink the archive-z2 objects prepared by stage_archive_objects()
+        into OSTREE_REPO. pull-local then finds those objects already
+        present and only needs to copy the metadata objects. Falls back to
+        copying when the staging area is on a different filesystem.
+
+        The content checksum of each object is recomputed first and must
+        match its name. Objects which fail that check are removed from the
+        staging area and left to pull-local.
+        """
+        if not os.path.isdir(self.OSTREE_ARCHIVE_STAGING):
+            return
+
+        start = time.time()
+        objects = os.path.join(self.OSTREE_REPO, 'objects')
+        pending = []
+        present = 0
+        for root, dirs, filenames in os.walk(self.OSTREE_ARCHIVE_STAGING):
+            for filename in filenames:
+                src = os.path.join(root, filename)
+                dst = os.path.join(objects, os.path.relpath(src, self.OSTREE_ARCHIVE_STAGING))
+                if os.path.exists(dst):
+                    present += 1
+                else:
+                    pending.append((src, dst))
+
+        def verify(paths):
+            src, dst = paths
+            expected = os.path.basename(os.path.dirname(src)) + os.path.basename(src)[:-len('.filez')]
+            try:
+                checksum = archive.checksum_object(src)
+            except ValueError as ex:
+                return '%s: %s' % (src, ex)
+            if checksum != expected:
+                return '%s: content checksum is %s' % (src, checksum)
+            return None
+
+        # Same as in stage_archive_objects(), zlib and hashlib release the GIL.
+        linked = copied = rejected = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            for (src, dst), error in zip(pending, executor.map(verify, pending)):
+                if error:
+                    bb.warn('Not using staged archive-z2 object %s' % error)
+                    os.unlink(src)
+                    rejected += 1
+                    continue
+                bb.utils.mkdirhier(os.path.dirname(dst))
+                try:
+                    os.link(src, dst + '.tmp')
+                    linked += 1
+                except OSError as ex:
+                    if ex.errno != errno.EXDEV:
+                        raise
+                    shutil.copyfile(src, dst + '.tmp')
+                    os.chmod(dst + '.tmp', 0o644)
+                    copied += 1
+                os.rename(dst + '.tmp', dst)
+        bb.note(self.format('Added staged objects to {OSTREE_REPO} in %.1fs: %d linked, %d copied, %d already present, %d rejected.') %
+                (time.time() - start, linked, copied, present, rejected))
+
+    def get_delta_path(self, from_commit, to_commit):
+        """
+        Return the directory of a static delta inside OSTREE_REPO, using the
+        same modified base64 encoding of the checksums as OSTree.
+        """
+        def b64(checksum):
+            return base64.b64encode(bytes.fromhex(checksum)).decode('ascii').rstrip('=').replace('/', '_')
+        from_b64 = b64(from_commit)
+        to_b64 = b64(to_commit)
+        return os.path.join(self.OSTREE_REPO, 'deltas', from_b64[:2], from_b64[2:] + '-' + to_b64)
 
-        self.run_ostree('--repo={OSTREE_REPO} pull-local --remote={OSTREE_OS} {OSTREE_BARE} {OSTREE_BRANCHNAME}')
-        self.run_ostree('--repo={OSTREE_REPO} commit {gpg_sign} --branch={OSTREE_BRANCHNAME} --tree=ref={OSTREE_OS}:{OSTREE_BRANCHNAME}')
-        self.run_ostree('--repo={OSTREE_REPO} summary {gpg_sign} -u')
+    def generate_deltas(self):
+        """
+        Generate static deltas from the last OSTREE_DELTAS commits in the
+        branch to the current one, so that clients which are not too far
+        behind can fetch an update with a few requests instead of pulling
+        individual objects. Deltas which exist already are skipped, the
+        others get generated in parallel.
+        """
+        depth = int(self.OSTREE_DELTAS or '0')
+        if depth <= 0:
+            return
+
+        output = self.run_ostree('--repo={OSTREE_REPO} log {OSTREE_BRANCHNAME}').decode('utf-8')
+        commits = re.findall(r'^commit ([0-9a-f]{64})$', output, re.MULTILINE)
+        to_commit = commits[0]
+        existing = self.run_ostree('--repo={OSTREE_REPO} static-delta list').decode('utf-8').split()
+        from_commits = [c for c in commits[1:depth + 1] if '%s-%s' % (c, to_commit) not in existing]
+        if not from_commits:
+            bb.note('No new static deltas needed.')
+            return
+
+        def generate(from_commit):
+            start = time.time()
+            self.run_ostree('--repo={OSTREE_REPO} static-delta generate --from={0} --to={1}', from_commit, to_commit)
+            return time.time() - start
+
+        bb.note('Generating %d static delta(s) to commit %s ...' % (len(from_commits), to_commit))
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(from_commits), os.cpu_count() or 1)) as executor:
+            for from_commit, elapsed in zip(from_commits, executor.map(generate, from_commits)):
+                size = 0
+                for root, dirs, files in os.walk(self.get_delta_path(from_commit, to_commit)):
+                    size += sum(os.lstat(os.path.join(root, f)).st_size for f in files)
+                bb.note('Static delta from %s: %d KiB, generated in %.1fs.' % (from_commit, size // 1024, elapsed))
+        bb.note('Generated static deltas in %.1fs.' % (time.time() - start))
@@ -1,10 +1,18 @@
 # Python code implementing most of the logic behind
 # supported-recipes.bbclass.
 
+import ast
 import csv
+import hashlib
+import heapq
+import importlib
+import io
 import os
+import pickle
 import sys
 import re
+import tempfile
+import time
 try:
     import urlparse
 except ImportError:
@@ -26,7 +34,18 @@ class Columns(object):
     To add new classes, create a "lib/supportedrecipesreport" directory in your layer,
     with an empty "__init__.py" file and one or more classes inheriting from this base
     class defined in one or more regular .py files.
+
+    Classes should list the columns that they add in the "columns" class
+    attribute, as a literal list of strings, or inherit it from a base class
+    in the same module. This is read without importing the module, so modules
+    whose columns are not selected via SUPPORTED_RECIPES_SOURCES_COLUMNS do
+    not get imported at all. For that, classes must derive from Columns
+    directly or through classes in the same module. Classes without such a
+    list are only used when SUPPORTED_RECIPES_SOURCES_COLUMNS is empty.
     """
+
+    columns = ()
+
     def __init__(self, d, all_rows):
         """Initialize instance.
 
@@ -42,8 +61,10 @@ class Columns(object):
         resultig .cvs report will have them.  extend_header() then may
         extend the list of fields. See supportedrecipes.py for
         a list of already present fields.
+
+        The default implementation appends the declared columns.
         """
-        pass
+        row_headers.extend([c for c in self.columns if c not in row_headers])
 
     def extend_row(self, row):
         """Add data for new columns or modify existing ones.
@@ -74,8 +95,30 @@ class SupportedRecipe:
             raise RuntimeError("%s.%d: entry must have format <recipe name regex>@<collection name regex>, "
                                "splitting by @ found %d parts instead: %s" %
                                (filename, linenumber, len(parts), pattern))
-        self.pn_re = parse_regex(parts[0], filename, linenumber)
-        self.collection_re = parse_regex(parts[1], filename, linenumber)
+        self.pn_regex, self.collection_regex = parts
+        # Compile right away to report invalid entries while loading.
+        self._pn_re = parse_regex(self.pn_regex, filename, linenumber)
+        self._collection_re = parse_regex(self.collection_regex, filename, linenumber)
+
+    def __getstate__(self):
+        # Compiled regular expressions are not stored in the supported
+        # recipes cache. They get compiled again only when needed.
+        state = self.__dict__.copy()
+        state['_pn_re'] = None
+        state['_collection_re'] = None
+        return state
+
+    @property
+    def pn_re(self):
+        if self._pn_re is None:
+            self._pn_re = parse_regex(self.pn_regex, self.filename, self.linenumber)
+        return self._pn_re
+
+    @property
+    def collection_re(self):
+        if self._collection_re is None:
+            self._collection_re = parse_regex(self.collection_regex, self.filename, self.linenumber)
+        return self._collection_re
 
     def is_supportedby(self, pn, collection):
         # Returns string identifying the team supporting the recipe or
@@ -84,12 +127,104 @@ class SupportedRecipe:
                          (collection is None or self.collection_re[0].match(collection)))
         return self.supportedby if supported else ''
 
+# Flags of a regular expression without inline flags. Patterns which
+# set their own flags or use groups cannot be merged into a combined
+# alternation without changing their meaning.
+_DEFAULT_FLAGS = re.compile('').flags
+_SPECIAL_CHARS = set('.^$*+?{}[]|()')
+
+def regex_literal(regex):
+    # Returns the string matched by the regular expression if it
+    # matches exactly one string, None otherwise. Only escaped
+    # punctuation (as in gtk\+3) is allowed in addition to plain
+    # characters, everything else is treated as a real regular expression.
+    literal = []
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\':
+            if i + 1 < len(regex) and not regex[i + 1].isalnum() and regex[i + 1] != '_':
+                literal.append(regex[i + 1])
+                i += 2
+                continue
+            return None
+        if c in _SPECIAL_CHARS:
+            return None
+        literal.append(c)
+        i += 1
+    return ''.join(literal)
+
+class SupportedRecipesMatcher(object):
+    """Finds all teams supporting a recipe in a single pass.
+
+    Entries where both sides are literals go into a hash index. The
+    remaining entries are grouped by their collection regex and team,
+    with the recipe regexes of each group merged into one combined
+    alternation. Entries that cannot be merged without changing their
+    meaning are checked individually. The result is the same as
+    checking each SupportedRecipe in turn.
+    """
+    def __init__(self, supported):
+        # (pn, collection) -> set of teams
+        self.literals = {}
+        # collection regex -> (compiled collection regex, {team: [pn regex]})
+        self.collections = {}
+        # SupportedRecipe instances which have to be checked one-by-one.
+        self.others = []
+        for recipe in supported:
+            pn_literal = regex_literal(recipe.pn_re[1])
+            collection_literal = regex_literal(recipe.collection_re[1])
+            if pn_literal is not None and collection_literal is not None:
+                self.literals.setdefault((pn_literal, collection_literal), set()).add(recipe.supportedby)
+            elif recipe.pn_re[0].groups == 0 and recipe.pn_re[0].flags == _DEFAULT_FLAGS:
+                entry = self.collections.setdefault(recipe.collection_re[1], (recipe.collection_re[0], {}))
+                entry[1].setdefault(recipe.supportedby, []).append(recipe.pn_re[1])
+            else:
+                self.others.append(recipe)
+        self.combined = []
+        for collection_re, teams in self.collections.values():
+            # Each alternative is wrapped in a non-capturing group together with
+            # the trailing $ that parse_regex() adds, so an entry like "a|b" keeps
+            # its original meaning.
+            self.combined.append((collection_re,
+                                  [(team, re.compile('|'.join(['(?:%s$)' % regex for regex in sorted(set(regexes))])))
+                                   for team, regexes in sorted(teams.items())]))
+
+    def supportedby(self, pn, collection):
+        # Returns set of teams supporting the recipe.
+        result = set(self.literals.get((pn, collection), ()))
+        for collection_re, teams in self.combined:
+            if collection_re.match(collection):
+                for team, pn_re in teams:
+                    if team not in result and pn_re.match(pn):
+                        result.add(team)
+        for recipe in self.others:
+            supportedby = recipe.is_supportedby(pn, collection)
+            if supportedby:
+                result.add(supportedby)
+        return result
+
 class SupportedRecipes:
     def __init__(self):
         self.supported = []
+        self.matcher = None
+        # (pn, collection) -> list of teams, filled on demand and
+        # persistent when loaded via load_supported_recipes().
+        self.verdicts = {}
+        self.verdicts_modified = False
+        self.cache_key = None
+        self.cache_hit = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['matcher'] = None
+        state['verdicts_modified'] = False
+        return state
 
     def append(self, recipe):
         self.supported.append(recipe)
+        self.matcher = None
+        self.verdicts = {}
 
     def current_recipe_supportedby(self, d):
         pn = d.getVar('PN', True)
@@ -100,6 +235,22 @@ class SupportedRecipes:
     def recipe_supportedby(self, pn, collection):
         # Returns list of of teams supporting the recipe (could be
         # more than one or none).
+        if pn is None or collection is None:
+            # Wildcard lookups are rare, the compiled matcher
+            # only handles complete lookups.
+            return self.recipe_supportedby_linear(pn, collection)
+        key = (pn, collection)
+        verdict = self.verdicts.get(key, None)
+        if verdict is None:
+            if self.matcher is None:
+                self.matcher = SupportedRecipesMatcher(self.supported)
+            verdict = sorted(self.matcher.supportedby(pn, collection))
+            self.verdicts[key] = verdict
+            self.verdicts_modified = True
+        return verdict[:]
+
+    def recipe_supportedby_linear(self, pn, collection):
+        # Same as recipe_supportedby(), but checks each entry in turn.
         result = set()
         for recipe in self.supported:
             supportedby = recipe.is_supportedby(pn, collection)
@@ -108,39 +259,184 @@ class SupportedRecipes:
         return sorted(result)
 
 
+# Bump when changing the content of the pickled SupportedRecipes instance.
+CACHE_VERSION = '1'
+# Number of older cache files kept around in SUPPORTED_RECIPES_CACHE,
+# for example for switching back and forth between configurations.
+CACHE_MAX_FILES = 5
+
+# Loaded instances, per process and cache key. Avoids reading the same
+# files again for each recipe that gets parsed.
+_loaded_supported_recipes = {}
+
+def supported_recipes_cachefile(d, cache_key):
+    cachedir = d.getVar('SUPPORTED_RECIPES_CACHE', True)
+    if not cachedir:
+        return None
+    return os.path.join(cachedir, 'supported-recipes-%s.pickle' % cache_key)
+
+def save_supported_recipes(d, supported_recipes):
+    # Stores the entries and all verdicts that were determined so far
+    # in SUPPORTED_RECIPES_CACHE, if anything changed since loading.
+    if not supported_recipes.verdicts_modified or not supported_recipes.cache_key:
+        return
+    cachefile = supported_recipes_cachefile(d, supported_recipes.cache_key)
+    if not cachefile:
+        return
+    cachedir = os.path.dirname(cachefile)
+    bb.utils.mkdirhier(cachedir)
+    # Several bitbake processes might write at the same time,
+    # therefore write a temporary file and rename it.
+    tmpfile = '%s.%d' % (cachefile, os.getpid())
+    with open(tmpfile, 'wb') as f:
+        pickle.dump(supported_recipes, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpfile, cachefile)
+    supported_recipes.verdicts_modified = False
+    cachefiles = [os.path.join(cachedir, x) for x in os.listdir(cachedir) if x.endswith('.pickle')]
+    if len(cachefiles) > CACHE_MAX_FILES:
+        cachefiles.sort(key=lambda x: os.stat(x).st_mtime, reverse=True)
+        for obsolete in cachefiles[CACHE_MAX_FILES:]:
+            try:
+                os.unlink(obsolete)
+            except OSError:
+                pass
+
+# Verdicts of the previous check_build(), stored in SUPPORTED_RECIPES_CACHE.
+CHECK_STATE = 'check-state.pickle'
+
+def check_state_config(d, supported_recipes):
+    # Everything besides the recipe itself which has an effect on
+    # the verdict. When any of it changes, all recipes must be checked again.
+    config = hashlib.sha256(CACHE_VERSION.encode('utf-8'))
+    config.update((supported_recipes.cache_key or '').encode('utf-8'))
+    collections = (d.getVar('BBFILE_COLLECTIONS', True) or '').split()
+    for var in ['SUPPORTED_RECIPES_NATIVE_RECIPES',
+                'SUPPORTED_RECIPES_NATIVE_BASECLASSES',
+                'BBLAYERS',
+                'BBFILE_COLLECTIONS'] + \
+               ['BBFILE_PATTERN_%s' % collection for collection in collections]:
+        config.update(b'\0')
+        config.update((d.getVar(var, True) or '').encode('utf-8'))
+    return config.hexdigest()
+
+def load_check_state(d, config):
+    # Returns the previous verdicts as hash from recipe name to
+    # (filename, inherits hash, native, collection, supportedby),
+    # or an empty hash if not available or obsolete.
+    cachedir = d.getVar('SUPPORTED_RECIPES_CACHE', True)
+    if not cachedir:
+        return {}
+    statefile = os.path.join(cachedir, CHECK_STATE)
+    try:
+        with open(statefile, 'rb') as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as ex:
+        bb.debug(1, 'Ignoring invalid supported recipes check state %s: %s' % (statefile, ex))
+        return {}
+    if state.get('config', None) != config:
+        return {}
+    return state['recipes']
+
+def save_check_state(d, config, recipes):
+    cachedir = d.getVar('SUPPORTED_RECIPES_CACHE', True)
+    if not cachedir:
+        return
+    bb.utils.mkdirhier(cachedir)
+    statefile = os.path.join(cachedir, CHECK_STATE)
+    tmpfile = '%s.%d' % (statefile, os.getpid())
+    with open(tmpfile, 'wb') as f:
+        pickle.dump({'config': config, 'recipes': recipes}, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpfile, statefile)
+
 def load_supported_recipes(d):
 
     files = []
     supported_files = d.getVar('SUPPORTED_RECIPES', True)
     if not supported_files:
         bb.fatal('SUPPORTED_RECIPES is not set')
-    supported_recipes = SupportedRecipes()
+    # The cache key depends on the content of the files and the
+    # team names assigned to them.
+    entries = []
+    memo_key = []
+    cache_hash = hashlib.sha256(CACHE_VERSION.encode('utf-8'))
     for filename in supported_files.split():
         try:
             base = os.path.basename(filename)
             supportedby = d.getVarFlag('SUPPORTED_RECIPES', base, True)
             if not supportedby:
                 supportedby = base.rstrip('.txt')
-            with open(filename) as f:
-                linenumber = 1
-                for line in f:
-                    if line.startswith('#'):
-                        continue
-                    # TODO (?): sanity check the content to catch
-                    # obsolete entries or typos.
-                    pn = line.strip()
-                    if pn:
-                        supported_recipes.append(SupportedRecipe(line.strip(),
-                                                                 supportedby,
-                                                                 filename,
-                                                                 linenumber))
-                    linenumber += 1
+            st = os.stat(filename)
+            memo_key.append((filename, supportedby, st.st_mtime_ns, st.st_size))
+            entries.append((filename, supportedby))
             files.append(filename)
         except OSError as ex:
             bb.fatal('Could not read SUPPORTED_RECIPES = %s: %s' % (supported_files, str(ex)))
 
+    memo_key = tuple(memo_key)
+    supported_recipes = _loaded_supported_recipes.get(memo_key, None)
+    if supported_recipes is not None:
+        supported_recipes.cache_hit = True
+        return (supported_recipes, files)
+
+    contents = []
+    for filename, supportedby in entries:
+        try:
+            with open(filename, 'rb') as f:
+                content = f.read()
+        except OSError as ex:
+            bb.fatal('Could not read SUPPORTED_RECIPES = %s: %s' % (supported_files, str(ex)))
+        contents.append(content)
+        for value in (filename, supportedby):
+            cache_hash.update(value.encode('utf-8'))
+            cache_hash.update(b'\0')
+        cache_hash.update(hashlib.sha256(content).digest())
+    cache_key = cache_hash.hexdigest()
+
+    cachefile = supported_recipes_cachefile(d, cache_key)
+    if cachefile and os.path.exists(cachefile):
+        try:
+            with open(cachefile, 'rb') as f:
+                supported_recipes = pickle.load(f)
+            supported_recipes.cache_hit = True
+        except Exception as ex:
+            bb.debug(1, 'Ignoring invalid supported recipes cache %s: %s' % (cachefile, ex))
+            supported_recipes = None
+
+    if supported_recipes is None:
+        supported_recipes = SupportedRecipes()
+        for (filename, supportedby), content in zip(entries, contents):
+            linenumber = 1
+            for line in content.decode('utf-8').split('\n'):
+                if line.startswith('#'):
+                    continue
+                # TODO (?): sanity check the content to catch
+                # obsolete entries or typos.
+                pn = line.strip()
+                if pn:
+                    supported_recipes.append(SupportedRecipe(line.strip(),
+                                                             supportedby,
+                                                             filename,
+                                                             linenumber))
+                linenumber += 1
+    supported_recipes.cache_key = cache_key
+
+    _loaded_supported_recipes.clear()
+    _loaded_supported_recipes[memo_key] = supported_recipes
     return (supported_recipes, files)
 
+def split_multiconfig_prefix(name):
+    # Returns multiconfig name (empty for the default one) and
+    # name without multiconfig prefix.
+    parts = name.split(':')
+    if len(parts) >= 2 and parts[0] in ('multiconfig', 'mc'):
+        if len(parts) == 2:
+            # See strip_multiconfig_prefix() for this case.
+            return parts[1].split('.', 1)[0], strip_multiconfig_prefix(name)
+        return parts[1], strip_multiconfig_prefix(name)
+    return '', strip_multiconfig_prefix(name)
+
 def strip_multiconfig_prefix(name):
     parts = name.split(':')
     # There's an open bug about
@@ -196,25 +492,243 @@ def gather_sources(d):
         rows.append((fullname, collection, pv, homepage, url, summary, license))
     return rows
 
+# The information collected by dump_sources() for all recipes is stored
+# in a single file inside SUPPORTED_RECIPES_SOURCES_DIR. Each record starts
+# with a header row (SOURCES_RECORD, multiconfig, pn, filename, number of rows,
+# size of the rows in bytes), followed by the rows with SOURCE_FIELDS. New
+# records get appended, so the last record for a recipe is the valid one.
+#
+# Appending happens while holding a bb.utils.lockfile() lock, the same kind
+# of lock that bitbake itself uses for stamps and sstate in TMPDIR, so the
+# directory must support it anyway. A plain log is used instead of a database
+# because appending a record is a single write and a record that got cut off
+# (for example, when a parser process gets killed) only loses that record:
+# the size in the header and the record marker at the start of a line are
+# enough to find the next intact record.
+#
+# SOURCES_INDEX caches the location of the current record of each recipe and
+# how much of the log has been read, so loading the log only needs to read
+# the records that were appended since the previous load.
+SOURCES_LOG = 'sources.csv'
+SOURCES_INDEX = SOURCES_LOG + '.index'
+SOURCES_INDEX_VERSION = '1'
+SOURCES_RECORD = '@recipe'
+
+def sources_log_lock(dirname):
+    bb.utils.mkdirhier(dirname)
+    return bb.utils.lockfile(os.path.join(dirname, SOURCES_LOG + '.lock'))
+
+def encode_sources_header(key, count, size):
+    header = io.StringIO()
+    csv.writer(header).writerow((SOURCES_RECORD,) + tuple(key) + (count, size))
+    return header.getvalue().encode('utf-8')
+
+def encode_sources_rows(rows):
+    body = io.StringIO()
+    csv.writer(body).writerows(rows)
+    return body.getvalue().encode('utf-8')
+
+def decode_sources_rows(body, count):
+    # Returns the rows of a record, or None if the record is damaged.
+    if not body.endswith(b'\n'):
+        return None
+    try:
+        rows = list(csv.reader(io.StringIO(body.decode('utf-8'), newline=''), strict=True))
+    except (UnicodeDecodeError, csv.Error):
+        return None
+    if len(rows) != count or [row for row in rows if len(row) != len(SOURCE_FIELDS)]:
+        return None
+    return rows
+
+def decode_sources_header(line):
+    # Returns (key, number of rows, size of the rows) or None.
+    if not line.startswith(SOURCES_RECORD.encode('utf-8') + b','):
+        return None
+    try:
+        header = next(csv.reader([line.decode('utf-8')], strict=True))
+        if len(header) != 6:
+            return None
+        return (tuple(header[1:4]), int(header[4]), int(header[5]))
+    except (UnicodeDecodeError, csv.Error, ValueError):
+        return None
+
+class SourcesLog(object):
+    """The current records in the SOURCES_LOG of a directory.
+
+    Maps (multiconfig, pn, filename) to the location of the most recent
+    record for that recipe. The rows themselves only get read by rows().
+    """
+    def __init__(self, dirname):
+        self.logfile = os.path.join(dirname, SOURCES_LOG)
+        self.indexfile = os.path.join(dirname, SOURCES_INDEX)
+        self.f = None
+        # key -> (offset of the rows, size of the rows, number of rows)
+        self.records = {}
+        # Number of all records in the log, including superseded
+        # and damaged ones.
+        self.total = 0
+        self.damaged = 0
+        # Offset up to which the log has been read.
+        self.end = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def read(self, key):
+        # Returns the rows of a record as bytes.
+        offset, size, count = self.records[key]
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def rows(self, key):
+        return decode_sources_rows(self.read(key), self.records[key][2])
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def index_check(self):
+        # Identifies the log content up to self.end.
+        self.f.seek(max(0, self.end - 4096))
+        return (os.fstat(self.f.fileno()).st_ino,
+                hashlib.sha1(self.f.read(self.end - self.f.tell())).hexdigest())
+
+    def load_index(self):
+        try:
+            with open(self.indexfile, 'rb') as f:
+                index = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            return
+        if not isinstance(index, tuple) or len(index) != 6 or index[0] != SOURCES_INDEX_VERSION:
+            return
+        version, check, self.end, self.records, self.total, self.damaged = index
+        if self.end > os.fstat(self.f.fileno()).st_size or self.index_check() != check:
+            # The log was replaced or modified since writing the index.
+            self.records = {}
+            self.total = self.damaged = self.end = 0
+
+    def save_index(self):
+        index = (SOURCES_INDEX_VERSION, self.index_check(), self.end,
+                 self.records, self.total, self.damaged)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.indexfile), delete=False) as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(f.name, self.indexfile)
+
+    def load(self):
+        try:
+            self.f = open(self.logfile, 'rb')
+        except FileNotFoundError:
+            return
+        self.load_index()
+        start = self.end
+        self.scan()
+        if self.end != start:
+            self.save_index()
+
+    def scan(self):
+        # Reads the records after self.end. An incomplete record at the end
+        # might still be getting written and is left for the next scan.
+        # Damaged records get skipped by searching for the next line with
+        # a valid record header.
+        f = self.f
+        f.seek(self.end)
+        damaged = False
+        while True:
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                break
+            header = decode_sources_header(line)
+            if header:
+                key, count, size = header
+                offset = f.tell()
+                body = f.read(size)
+                if len(body) < size:
+                    break
+                if decode_sources_rows(body, count) is not None:
+                    self.records[key] = (offset, size, count)
+                    self.total += 1
+                    self.end = f.tell()
+                    damaged = False
+                    continue
+                f.seek(offset)
+            if not damaged:
+                self.damaged += 1
+                self.total += 1
+                damaged = True
+            self.end = f.tell()
+
+def load_sources(dirname):
+    # Returns the SourcesLog with the records in the directory.
+    sources = SourcesLog(dirname)
+    sources.load()
+    return sources
+
+def compact_sources(dirname):
+    # Replaces the log with one containing just the current records,
+    # which also drops damaged and incomplete records.
+    lock = sources_log_lock(dirname)
+    try:
+        sources = load_sources(dirname)
+        compacted = SourcesLog(dirname)
+        tmpfile = compacted.logfile + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            for key in sorted(sources.records):
+                offset, size, count = sources.records[key]
+                f.write(encode_sources_header(key, count, size))
+                compacted.records[key] = (f.tell(), size, count)
+                f.write(sources.read(key))
+            compacted.total = len(compacted.records)
+            compacted.end = f.tell()
+        sources.close()
+        # Without an index, a stale one cannot get used for the new log.
+        if os.path.exists(compacted.indexfile):
+            os.unlink(compacted.indexfile)
+        os.rename(tmpfile, compacted.logfile)
+        compacted.f = open(compacted.logfile, 'rb')
+        compacted.save_index()
+        return compacted
+    finally:
+        bb.utils.unlockfile(lock)
+
 # Collects information about one recipe during parsing for SUPPORTED_RECIPES_SOURCES.
 # The dumped information cannot be removed because it might be needed in future
 # bitbake invocations, so the default location is inside the tmp directory.
 def dump_sources(d):
+    # bitbake-worker parses the recipe again for each task that it executes.
+    # That yields the same record as the parsing which populated the cache,
+    # so only that parsing needs to write it.
+    if d.getVar('BB_WORKERCONTEXT', True) == '1':
+        return
     pn = d.getVar('PN', True)
     # We need to distinguish between different multiconfigs. Below we get pn with
     # multiconfig prefix if it is not 'default', so do the same here.
     mc = d.getVar('BB_CURRENT_MC', True)
-    if mc and mc != 'default':
-        pn = 'multiconfig:%s:%s' % (mc, pn)
+    if not mc or mc == 'default':
+        mc = ''
     filename = d.getVar('FILE', True)
     rows = gather_sources(d)
-    dumpfile = d.getVar('SUPPORTED_RECIPES_SOURCES_DIR', True) + '/' + pn + filename
-    bb.utils.mkdirhier(os.path.dirname(dumpfile))
-    with open(dumpfile, 'w') as f:
-        # File intentionally kept small by not writing a header
-        # line. Guaranteed to contain SOURCE_FIELDS.
-        writer = csv.writer(f)
-        writer.writerows(rows)
+    body = encode_sources_rows(rows)
+    record = encode_sources_header((mc, pn, filename), len(rows), len(body)) + body
+    # Written in one go, while holding the lock, because recipes
+    # get parsed by several processes in parallel.
+    dirname = d.getVar('SUPPORTED_RECIPES_SOURCES_DIR', True)
+    lock = sources_log_lock(dirname)
+    try:
+        with open(os.path.join(dirname, SOURCES_LOG), 'a+b') as f:
+            # A record that did not get written completely might end in
+            # the middle of a line. Records must start on a new line.
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    record = b'\n' + record
+            f.write(record)
+    finally:
+        bb.utils.unlockfile(lock)
 
 class IsNative(object):
     def __init__(self, d):
@@ -233,14 +747,11 @@ class IsNative(object):
         if self.isnative_exception.match(pn):
             return True
 
-class TruncatedError(Exception):
-    pass
-
-def dump_dependencies(depgraph, max_lines, unsupported):
+def dump_dependencies(depgraph, max_lines, unsupported, shortest=False):
     # Walk the recipe dependency tree and add one line for each path that ends in
-    # an unsupported recipe.
+    # an unsupported recipe. With shortest=True, only the shortest path to
+    # each unsupported recipe is added.
     lines = []
-    current_line = []
 
     # Pre-compute complete dependencies (DEPEND and RDEPEND) for each recipe
     # instead of doing it each time we reach a recipe. Also identifies those
@@ -258,44 +769,93 @@ def dump_dependencies(depgraph, max_lines, unsupported):
     for pn in deps:
         deps[pn] = sorted(deps[pn])
 
-    # We can prune the search tree a lot by keeping track of those recipes which are already
-    # known to not depend on an unsupported recipe.
-    okay = set()
-
-    def visit_recipe(pn):
-        if pn in okay:
-            return False
-        if pn in current_line:
-            # Recursive dependency, bail out. Can happen
-            # because we flattened the task dependencies; those don't have
-            # cycles.
-            return False
-        current_line.append(pn)
-        printed = False
+    # We can prune the search tree a lot by only following recipes
+    # which depend (directly or indirectly) on an unsupported recipe.
+    # Determined once for each recipe by walking the reverse dependencies,
+    # starting at the unsupported recipes.
+    rdeps = {}
+    for pn, pndeps in deps.items():
+        for dep in pndeps:
+            rdeps.setdefault(dep, []).append(pn)
+    reaches = set([pn for pn in set(depgraph['pn']).union(deps, rdeps) if pn in unsupported])
+    pending = list(reaches)
+    while pending:
+        for pn in rdeps.get(pending.pop(), []):
+            if pn not in reaches:
+                reaches.add(pn)
+                pending.append(pn)
+
+    if shortest:
+        return dump_shortest_dependencies(deps, roots, reaches, max_lines, unsupported)
+
+    # Depth-first search with an explicit stack instead of recursion,
+    # because dependency chains in large builds can get longer than
+    # the Python recursion limit. Each stack entry is
+    # [recipe, iterator over remaining dependencies, printed].
+    for root in sorted(roots):
+        if root not in reaches:
+            continue
+        current_line = [root]
+        on_line = set(current_line)
+        stack = [[root, iter(deps.get(root, [])), False]]
+        while stack:
+            entry = stack[-1]
+            for dep in entry[1]:
+                # Recipes already in the current line are recursive
+                # dependencies. Can happen because we flattened the task
+                # dependencies; those don't have cycles.
+                if dep in reaches and dep not in on_line:
+                    current_line.append(dep)
+                    on_line.add(dep)
+                    stack.append([dep, iter(deps.get(dep, [])), False])
+                    break
+            else:
+                pn, _, printed = stack.pop()
+                if not printed and \
+                   pn in unsupported and \
+                   not len(current_line) == 1:
+                    # Current path is non-trivial, ends in an unsupported recipe and was not alread
+                    # included in a longer, printed path. Add a copy to the output.
+                    if len(lines) >= max_lines:
+                        return lines, True
+                    lines.append(current_line[:])
+                    printed = True
+                if printed and stack:
+                    stack[-1][2] = True
+                on_line.discard(pn)
+                del current_line[-1]
+    return lines, False
+
+def dump_shortest_dependencies(deps, roots, reaches, max_lines, unsupported):
+    # Breadth-first search from all start points at once. The first time
+    # that an unsupported recipe is reached is via the shortest
+    # dependency chain.
+    parents = {}
+    queue = []
+    for root in sorted(roots):
+        if root in reaches:
+            parents[root] = None
+            queue.append(root)
+    found = []
+    for pn in queue:
+        if pn in unsupported and parents[pn] is not None:
+            found.append(pn)
         for dep in deps.get(pn, []):
-            if visit_recipe(dep):
-                printed = True
-        if not printed and \
-           pn in unsupported and \
-           not len(current_line) == 1:
-            # Current path is non-trivial, ends in an unsupported recipe and was not alread
-            # included in a longer, printed path. Add a copy to the output.
-            if len(lines) >= max_lines:
-                raise TruncatedError()
-            lines.append(current_line[:])
-            printed = True
-        if not printed and not pn in unsupported:
-            okay.add(pn)
-        del current_line[-1]
-        return printed
-
-    truncated = False
-    try:
-        for pn in sorted(roots):
-            visit_recipe(pn)
-    except TruncatedError:
-        truncated = True
-    return lines, truncated
+            if dep in reaches and dep not in parents:
+                parents[dep] = pn
+                queue.append(dep)
+
+    lines = []
+    for pn in sorted(found):
+        if len(lines) >= max_lines:
+            return lines, True
+        line = []
+        while pn is not None:
+            line.append(pn)
+            pn = parents[pn]
+        line.reverse()
+        lines.append(line)
+    return lines, False
 
 def collection_hint(pn, supported_recipes):
     # Determines whether the recipe would be supported in some other collection.
@@ -322,7 +882,240 @@ def dump_unsupported(unsupported, supported_recipes):
         lines.append(entry)
     return sorted(lines)
 
+# Maximum number of rows that sorted_unique() keeps in memory.
+REPORT_RUN_SIZE = 20000
+
+def sorted_unique(rows, tmpdir=None, run_size=REPORT_RUN_SIZE):
+    # Same result as sorted(set(rows)), but only up to run_size rows are
+    # kept in memory. Larger inputs get split into sorted runs which are
+    # stored in temporary files and merged at the end. The runs are
+    # pickled because the rows may contain values other than strings.
+    runs = []
+    run = set()
+    try:
+        for row in rows:
+            run.add(row)
+            if len(run) >= run_size:
+                f = tempfile.TemporaryFile(dir=tmpdir)
+                runs.append(f)
+                for entry in sorted(run):
+                    pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+                run = set()
+        if not runs:
+            yield from sorted(run)
+            return
+
+        def read_run(f):
+            f.seek(0)
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+        previous = None
+        for entry in heapq.merge(sorted(run), *[read_run(f) for f in runs]):
+            # Duplicates are next to each other after merging.
+            if previous is None or entry != previous:
+                yield entry
+                previous = entry
+    finally:
+        for f in runs:
+            f.close()
+
+class ColumnsRegistry(object):
+    """Finds the Columns extensions in supportedrecipesreport.
+
+    Extension modules are parsed instead of imported to find the classes
+    defined in them and the columns that those declare. The result is cached
+    per module file and only refreshed when the file changes, so inside the
+    bitbake server this happens once. Modules only get imported when one of
+    their classes is needed for the report.
+    """
+    def __init__(self):
+        # filename -> (mtime, [(class name, declared columns or None)])
+        self.modules = {}
+        # module name -> mtime of the file when it was imported
+        self.imported = {}
+
+    def parse(self, filename):
+        # Returns (class name, declared columns or None) for the classes
+        # derived from Columns, directly or through classes defined in the
+        # same module. A class name of None means that the module could not
+        # be parsed and all classes in it need to be checked after importing it.
+        try:
+            with open(filename, 'rb') as f:
+                tree = ast.parse(f.read(), filename)
+        except (OSError, SyntaxError):
+            return [(None, None)]
+        nodes = dict([(node.name, node) for node in tree.body if isinstance(node, ast.ClassDef)])
+        # Names under which the module refers to the Columns base class.
+        base_names = set(['Columns'])
+        for node in tree.body:
+            if isinstance(node, ast.ImportFrom) and node.module == 'supportedrecipes':
+                base_names.update([alias.asname for alias in node.names if alias.name == 'Columns' and alias.asname])
+        base_names.difference_update(nodes)
+
+        def is_columns(base):
+            if isinstance(base, ast.Name):
+                return base.id in base_names
+            return isinstance(base, ast.Attribute) and base.attr == 'Columns' and \
+                isinstance(base.value, ast.Name) and base.value.id == 'supportedrecipes'
+
+        def declared(node):
+            # The columns assigned in the class body, None when they are
+            # not a literal list of strings, False without an assignment.
+            columns = False
+            for statement in node.body:
+                if isinstance(statement, ast.Assign) and \
+                   [t.id for t in statement.targets if isinstance(t, ast.Name)] == ['columns']:
+                    try:
+                        columns = ast.literal_eval(statement.value)
+                        if isinstance(columns, (str, bytes)):
+                            columns = None
+                        else:
+                            columns = tuple(columns)
+                            if [c for c in columns if not isinstance(c, str)]:
+                                columns = None
+                    except (ValueError, TypeError, SyntaxError):
+                        columns = None
+            return columns
+
+        def resolve(name, seen):
+            # Returns (derived from Columns, columns). Columns which are not
+            # assigned in the class itself are looked up depth-first in its
+            # bases from this module.
+            node = nodes[name]
+            extension = False
+            columns = declared(node)
+            for base in node.bases:
+                if is_columns(base):
+                    extension = True
+                elif isinstance(base, ast.Name) and base.id in nodes and base.id not in seen:
+                    base_extension, base_columns = resolve(base.id, seen | set([base.id]))
+                    if base_extension:
+                        extension = True
+                        if columns is False:
+                            columns = base_columns
+            return extension, columns
+
+        classes = []
+        for name in nodes:
+            extension, columns = resolve(name, set([name]))
+            if extension:
+                # Without any assignment, only the empty default of
+                # Columns is left, which also counts as undeclared.
+                classes.append((name, None if columns is False else columns))
+        return sorted(classes)
+
+    def scan(self):
+        # Returns (module name, mtime, classes) for all extension modules.
+        result = []
+        seen = set()
+        for finder, modname, ispkg in pkgutil.iter_modules(supportedrecipesreport.__path__):
+            if modname in seen:
+                # Hidden by a module of the same name earlier in the path.
+                continue
+            seen.add(modname)
+            if ispkg:
+                filename = os.path.join(finder.path, modname, '__init__.py')
+            else:
+                filename = os.path.join(finder.path, modname + '.py')
+            try:
+                mtime = os.stat(filename).st_mtime_ns
+            except OSError:
+                result.append((modname, None, [(None, None)]))
+                continue
+            cached = self.modules.get(filename, None)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, self.parse(filename))
+                self.modules[filename] = cached
+            result.append((modname, mtime, cached[1]))
+        return result
+
+    def load(self, modname, mtime):
+        fullname = 'supportedrecipesreport.' + modname
+        module = importlib.import_module(fullname)
+        if modname in self.imported and self.imported[modname] != mtime:
+            module = importlib.reload(module)
+        self.imported[modname] = mtime
+        return module
+
+    def classes(self, requested=None):
+        # Returns (class, declared columns or None) for all extension classes
+        # which add at least one of the requested columns (all when None).
+        # Classes which do not declare their columns are only used when
+        # all are requested.
+        result = []
+        undeclared = []
+        for modname, mtime, classes in self.scan():
+            wanted = []
+            for name, columns in classes:
+                if name is None or requested is None or (columns is not None and requested.intersection(columns)):
+                    wanted.append((name, columns))
+                elif columns is None:
+                    undeclared.append('%s.%s' % (modname, name))
+            if not wanted:
+                continue
+            module = self.load(modname, mtime)
+            if wanted[0][0] is None:
+                wanted = [(name, None) for name, clazz in inspect.getmembers(module, inspect.isclass)
+                          if clazz.__module__ == module.__name__]
+            for name, columns in wanted:
+                clazz = getattr(module, name, None)
+                if inspect.isclass(clazz) and issubclass(clazz, Columns):
+                    result.append((clazz, columns))
+        if undeclared:
+            bb.note('Not using SUPPORTED_RECIPES_SOURCES extensions without a literal list of columns: %s' %
+                    ', '.join(undeclared))
+        return result
+
+columns_registry = ColumnsRegistry()
+
+def write_sources_report(d, f, rows, tmpdir=None):
+    # Writes the SUPPORTED_RECIPES_SOURCES report for the given row hashes.
+    # Extensions are applied to one row at a time while streaming the rows
+    # into the external sort.
+    fields = SOURCE_FIELDS[:]
+    # Insert after 'collection'.
+    fields.insert(fields.index('collection') + 1, 'supported')
+    requested = d.getVar('SUPPORTED_RECIPES_SOURCES_COLUMNS', True)
+    requested = set(requested.split()) if requested else None
+    classes = columns_registry.classes(requested)
+    # The default Columns.__init__() ignores all_rows. Extensions which
+    # implement their own may look at all rows at any time, so then
+    # all rows get collected in a list first and the same row hashes
+    # get extended and written.
+    if [clazz for clazz, columns in classes if clazz.__init__ is not Columns.__init__]:
+        rows = list(rows)
+    # The columns of extensions which use the default extend_header()
+    # are known from parsing them. Such extensions only get instantiated
+    # when they implement __init__() or extend_row().
+    extensions = []
+    for clazz, columns in classes:
+        if columns is not None and clazz.extend_header is Columns.extend_header:
+            fields.extend([c for c in columns if c not in fields])
+            if clazz.__init__ is not Columns.__init__ or clazz.extend_row is not Columns.extend_row:
+                extensions.append(clazz(d, rows))
+        else:
+            extension = clazz(d, rows)
+            extension.extend_header(fields)
+            extensions.append(extension)
+    writer = csv.writer(f)
+    writer.writerow(fields)
+    def extended_rows():
+        for row in rows:
+            for e in extensions:
+                e.extend_row(row)
+            yield tuple([row.get(f, None) for f in fields])
+    # Sort by first column, then second column, etc., after extending all rows.
+    # Also de-duplicate. Duplicates can occur when the exact same compontent
+    # is used multiple times by different recipes or we have a multiconfig build
+    # that builds the same recipe more than once.
+    for row in sorted_unique(extended_rows(), tmpdir):
+        writer.writerow(row)
+
 def check_build(d, event, tinfoil=None):
+    start = time.time()
     supported_recipes, files = load_supported_recipes(d)
     supported_recipes_check = d.getVar('SUPPORTED_RECIPES_CHECK', True)
     report_sources = d.getVar('SUPPORTED_RECIPES_SOURCES', True)
@@ -345,73 +1138,96 @@ def check_build(d, event, tinfoil=None):
 
     dirname = d.getVar('SUPPORTED_RECIPES_SOURCES_DIR', True)
 
+    if report_sources and not tinfoil:
+        dumped_sources = load_sources(dirname)
+
     unsupported = {}
+    # (log record key or recipe filename, supported) for each recipe in the
+    # report. The rows only get read while writing the report.
     sources = []
+
+    # Only recipes which are new or have a different filename or inherit
+    # something else than in the previous check need to be checked again.
+    config = check_state_config(d, supported_recipes)
+    # Verdicts of recipes which are not part of the current build are
+    # kept, because the next build might have different targets again.
+    previous = load_check_state(d, config)
+    current = dict(previous)
+    reevaluated = 0
+
     bb.note('Checking active recipes')
     for pn, pndata in depgraph['pn'].items():
         # Both SUPPORTED_RECIPES_NATIVE_RECIPES and the mapping files in SUPPORTED_RECIPES_SOURCES
         # are without the multiconfig prefix, so strip that.
         pn_stripped = strip_multiconfig_prefix(pn)
+        filename = pndata['filename']
+        inherits = hashlib.sha1('\n'.join(pndata['inherits']).encode('utf-8')).hexdigest()
+        verdict = previous.get(pn, None)
+        if verdict is None or verdict[0:2] != (filename, inherits):
+            reevaluated += 1
+            # We only care about recipes compiled for the target.
+            # Most native ones can be detected reliably because they inherit native.bbclass,
+            # but some special cases have to be hard-coded.
+            # Image recipes also do not matter.
+            if isnative(pn_stripped, pndata):
+                verdict = (filename, inherits, True, None, None)
+            else:
+                collection = bb.utils.get_file_layer(strip_multiconfig_prefix(filename), d)
+                supportedby = supported_recipes.recipe_supportedby(pn_stripped, collection)
+                verdict = (filename, inherits, False, collection, supportedby)
+        current[pn] = verdict
+        native, collection, supportedby = verdict[2:]
 
-        # We only care about recipes compiled for the target.
-        # Most native ones can be detected reliably because they inherit native.bbclass,
-        # but some special cases have to be hard-coded.
-        # Image recipes also do not matter.
-        if not isnative(pn_stripped, pndata):
-            filename = pndata['filename']
-            collection = bb.utils.get_file_layer(strip_multiconfig_prefix(filename), d)
-            supportedby = supported_recipes.recipe_supportedby(pn_stripped, collection)
+        if not native:
             if not supportedby:
                 unsupported[pn_stripped] = collection
             if report_sources:
-                def add_rows(rows):
-                    for row in rows:
-                        row_hash = {f: row[i] for i, f in enumerate(SOURCE_FIELDS)}
-                        row_hash['supported'] = 'yes (%s)' % ' '.join(supportedby) \
-                                            if supportedby else 'no'
-                        sources.append(row_hash)
-
+                supported = 'yes (%s)' % ' '.join(supportedby) \
+                            if supportedby else 'no'
                 if tinfoil:
-                    bb.note('Parsing %s' % filename)
-                    pn_d = tinfoil.parse_recipe_file(filename)
-                    rows = gather_sources(pn_d)
-                    add_rows(rows)
+                    sources.append((filename, supported))
                 else:
-                    dumpfile = os.path.join(dirname, pn + strip_multiconfig_prefix(filename))
-                    # Work around multiconfig:qemuarm.gcc vs multiconfig:qemuarm:gcc bug.
-                    if not os.path.exists(dumpfile):
-                        pn = re.sub(r'^multiconfig:([^:.]*)\.', r'multiconfig:\1:', pn)
-                        dumpfile2 = os.path.join(dirname, pn + strip_multiconfig_prefix(filename))
-                        if os.path.exists(dumpfile2):
-                            dumpfile = dumpfile2
-                    with open(dumpfile) as f:
-                        reader = csv.reader(f)
-                        add_rows(reader)
+                    mc = split_multiconfig_prefix(pn)[0]
+                    key = (mc, pn_stripped, strip_multiconfig_prefix(filename))
+                    if key not in dumped_sources:
+                        bb.fatal('%s: no information about %s from %s in %s, recipe must be parsed again' %
+                                 (pn, filename, mc or 'default', os.path.join(dirname, SOURCES_LOG)))
+                    sources.append((key, supported))
+    bb.note('Checked %d recipes, %d of them re-evaluated, in %.3fs (%s start, %d cached verdicts).' %
+            (len(depgraph['pn']), reevaluated, time.time() - start,
+             'warm' if supported_recipes.cache_hit else 'cold',
+             len(supported_recipes.verdicts)))
+    save_supported_recipes(d, supported_recipes)
+    if reevaluated:
+        save_check_state(d, config, current)
+
+    if report_sources and not tinfoil:
+        if dumped_sources.damaged or dumped_sources.total > 2 * len(dumped_sources):
+            # Recipes were parsed again since the last compaction, with most
+            # records superseded by newer ones, or some record got damaged.
+            if dumped_sources.damaged:
+                bb.note('Dropping %d damaged record(s) from %s.' %
+                        (dumped_sources.damaged, dumped_sources.logfile))
+            compact_sources(dirname).close()
 
     if report_sources:
+        def source_rows():
+            for source, supported in sources:
+                if tinfoil:
+                    bb.note('Parsing %s' % source)
+                    rows = gather_sources(tinfoil.parse_recipe_file(source))
+                else:
+                    # Still readable after a compaction, which only
+                    # replaces the log file.
+                    rows = dumped_sources.rows(source)
+                for row in rows:
+                    row_hash = {f: row[i] for i, f in enumerate(SOURCE_FIELDS)}
+                    row_hash['supported'] = supported
+                    yield row_hash
         def write_report(f):
-            fields = SOURCE_FIELDS[:]
-            # Insert after 'collection'.
-            fields.insert(fields.index('collection') + 1, 'supported')
-            extensions = []
-            for importer, modname, ispkg in pkgutil.iter_modules(supportedrecipesreport.__path__):
-                module = __import__('supportedrecipesreport.' + modname, fromlist="dummy")
-                for name, clazz in inspect.getmembers(module, inspect.isclass):
-                    if issubclass(clazz, Columns):
-                        extensions.append(clazz(d, sources))
-            for e in extensions:
-                e.extend_header(fields)
-            writer = csv.writer(f)
-            writer.writerow(fields)
-            for row in sources:
-                for e in extensions:
-                    e.extend_row(row)
-            # Sort by first column, then second column, etc., after extending all rows.
-            # Also de-duplicate. Duplicates can occur when the exact same compontent
-            # is used multiple times by different recipes or we have a multiconfig build
-            # that builds the same recipe more than once.
-            for row in sorted(set([tuple([r.get(f, None) for f in fields]) for r in sources])):
-                writer.writerow(row)
+            # Temporary files for sorting go next to the dumped sources.
+            bb.utils.mkdirhier(dirname)
+            write_sources_report(d, f, source_rows(), dirname)
         if report_sources == '-':
             write_report(sys.stdout)
         else:
@@ -421,10 +1237,17 @@ def check_build(d, event, tinfoil=None):
             with open(report_sources, 'w', encoding='utf-8') as f:
                 write_report(f)
         bb.note('Wrote supported recipes report to %s.' % ('stdout' if report_sources == '-' else report_sources))
+        if not tinfoil:
+            dumped_sources.close()
 
     if supported_recipes_check and unsupported:
         max_lines = int(d.getVar('SUPPORTED_RECIPES_CHECK_DEPENDENCY_LINES', True))
-        dependencies, truncated = dump_dependencies(depgraph, max_lines, unsupported)
+        chains = d.getVar('SUPPORTED_RECIPES_CHECK_DEPENDENCY_CHAINS', True) or 'all'
+        if chains not in ('all', 'shortest'):
+            bb.fatal('SUPPORTED_RECIPES_CHECK_DEPENDENCY_CHAINS must be set to all or shortest, currently is: %s' %
+                     chains)
+        dependencies, truncated = dump_dependencies(depgraph, max_lines, unsupported,
+                                                    shortest=chains == 'shortest')
 
         output = []
         output.append('The following unsupported recipes are required for the build:')
@@ -436,9 +1259,9 @@ format. Typically each layer has exactly one collection.''')
         if dependencies:
             # Add the optional dependency dump.
             output.append('''
-Here are the dependency chains (including DEPENDS and RDEPENDS)
+Here are the %sdependency chains (including DEPENDS and RDEPENDS)
 which include one or more of the unsupported recipes. -> means "depends on"
-and * marks unsupported recipes:''')
+and * marks unsupported recipes:''' % ('shortest ' if chains == 'shortest' else ''))
             for line in dependencies:
                 line_entries = [('*' if pn in unsupported else '') + pn for pn in line]
                 output.append('  ' + ' -> '.join(line_entries))
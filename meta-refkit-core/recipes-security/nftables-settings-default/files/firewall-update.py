@@ -2,86 +2,373 @@
 
 # TODO: allow defining the zones on-the-fly based on the configuration
 
+# Usage:
+#   firewall-update.py               update zones.ruleset and firewall.ruleset
+#   firewall-update.py --only-zones  update only zones.ruleset
+#   firewall-update.py --daemon      keep zones.ruleset up-to-date by listening
+#                                    to network interface changes via netlink
+#   firewall-update.py --daemon --incremental
+#                                    same, but also add and remove the changed
+#                                    interfaces directly in the ZONE_* sets
+#                                    instead of reloading the whole ruleset
+
 import os
 import sys
 import re
 import fcntl
 import configparser
+import errno
+import hashlib
+import select
+import socket
+import struct
+import subprocess
+import time
 
 zonesConfigPaths = ["/usr/lib/firewall/zones.config", "/etc/firewall/zones.config"]
 zonesTemplatePath = "/usr/lib/firewall/zones.template"
 zonesRulesetPath = "/run/firewall/zones.ruleset"
+# written when zones.ruleset needs to be reloaded (see firewall-config.path)
+zonesChangedPath = "/run/firewall/zones.changed"
 servicePaths = ["/usr/lib/firewall/services", "/etc/firewall/services"]
 configTemplatePath = "/usr/lib/firewall/firewall.template"
 configRulesetPath = "/run/firewall/firewall.ruleset"
+# sha256sum-style hashes of firewall.ruleset and the files it includes,
+# written after firewall.ruleset has changed (see firewall.path)
+configHashPath = "/run/firewall/firewall.sha256"
+variablesPath = "/usr/lib/firewall/variables.ruleset"
+lockPath = "/run/firewall/config_flock"
+nftPath = "/usr/sbin/nft"
+
+# the table containing the ZONE_* sets (see firewall.template)
+zonesTable = "inet filter"
+
+# zone config keys and the corresponding zones template fields
+zones = [
+    ("ZONE_LOCAL", "local_interfaces"),
+    ("ZONE_LAN", "lan_interfaces"),
+    ("ZONE_WAN", "wan_interfaces"),
+    ("ZONE_DMZ", "dmz_interfaces"),
+    ("ZONE_VPN", "vpn_interfaces"),
+    ("ZONE_ALL", "all_interfaces"),
+]
+
+# In daemon mode, wait until there have been no link events for this many
+# seconds before updating the zones, but not longer than the maximum delay
+# after the first event of a burst.
+debounceDelay = 0.2
+maxDelay = 1.0
+
+# from linux/netlink.h and linux/rtnetlink.h
+RTMGRP_LINK = 1
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+IFLA_IFNAME = 3
+nlmsghdr = struct.Struct("=IHHII")
+ifinfomsg = struct.Struct("=BxHiII")
+rtattr = struct.Struct("=HH")
+
+def lock():
+    # lock to prevent processing several events at once
+    f = open(lockPath, "w")
+    fcntl.lockf(f, fcntl.LOCK_EX)
+    return f
+
+class ZonesConfig:
+    """
+    The zone configuration with the interface regular expressions already
+    compiled. Remembers the modification times of the configuration files
+    so that a long-running process can tell when it needs to be reloaded.
+
+    Each distinct expression gets compiled once, no matter how many zones
+    use it, and the zones of each interface name are cached, so classifying
+    all interfaces is a single pass which only runs the expressions for
+    names that have not been seen before. The cache only holds the names
+    of the previous pass, so it does not grow on container hosts which
+    keep creating interfaces with new names.
+    """
+
+    def __init__(self):
+        self.stamp = self.get_stamp()
+        config = configparser.ConfigParser()
+        config.read(zonesConfigPaths)
+        # distinct expressions and the zones using them, in zone order
+        self.patterns = []
+        self.keys = []
+        if "match" in config:
+            regexps = {}
+            for key, field in zones:
+                if key in config["match"]:
+                    pattern = config["match"][key]
+                    if pattern not in regexps:
+                        regexps[pattern] = (re.compile(pattern), [])
+                        self.patterns.append(regexps[pattern])
+                    regexps[pattern][1].append(key)
+                    self.keys.append(key)
+        self.cache = {}
+        with open(zonesTemplatePath, "r") as f:
+            self.template = f.read()
+
+    @staticmethod
+    def get_stamp():
+        stamp = []
+        for path in zonesConfigPaths + [zonesTemplatePath]:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def is_current(self):
+        return self.get_stamp() == self.stamp
+
+    def zones_of(self, names):
+        # the configured zones of each interface, reusing those of the
+        # previous pass and dropping names which no longer exist
+        old = self.cache
+        self.cache = {}
+        for name in names:
+            keys = old.get(name)
+            if keys is None:
+                keys = []
+                for r, patternKeys in self.patterns:
+                    if r.search(name):
+                        keys += patternKeys
+            self.cache[name] = keys
+        return self.cache
 
-# lock to prevent processing several events at once
-lock = open("/run/firewall/config_flock", "w")
-fcntl.lockf(lock, fcntl.LOCK_EX)
+    def classify(self, interfaces):
+        # map each configured zone to the set of its interfaces, given as
+        # a dict of index -> name
+        members = dict([(key, set()) for key in self.keys])
+        cache = self.zones_of(interfaces.values())
+        for index, name in interfaces.items():
+            for key in cache[name]:
+                members[key].add(index)
+        return members
 
-# get available interfaces
-interfaces = os.listdir("/sys/class/net")
+    def render(self, interfaces):
+        # sort the interfaces of each zone into the template
+        members = dict([(key, []) for key in self.keys])
+        cache = self.zones_of(interfaces)
+        for name in interfaces:
+            for key in cache[name]:
+                members[key].append(name)
+        fields = {}
+        for key, field in zones:
+            if key in members:
+                fields[field] = "elements = { " + ", ".join(members[key]) + " }"
+            else:
+                fields[field] = ""
+        return self.template.format(**fields)
 
-# map interfaces to zones according to configuration
-config = configparser.ConfigParser()
-files = config.read(zonesConfigPaths)
+def get_interfaces():
+    # get available interfaces
+    return os.listdir("/sys/class/net")
 
-def search_interfaces(key, conf):
-    ret = ""
-    if "match" in conf:
-        if key in conf["match"]:
-            r = re.compile(conf["match"][key])
-            ifs = ", ".join([i for i in interfaces if r.search(i)])
-            ret = "elements = { " + ifs + " }"
+def write_zones(config, interfaces):
+    # Returns True if zones.ruleset changed.
+    output_data = config.render(sorted(interfaces))
 
-    return ret
+    # Do not write the ruleset file if it already exists and there is no change.
+    # This prevents unneccessary firewall setup changes.
 
-# run regexps on the interfaces
-local_ifs = search_interfaces("ZONE_LOCAL", config)
-lan_ifs = search_interfaces("ZONE_LAN", config)
-wan_ifs = search_interfaces("ZONE_WAN", config)
-dmz_ifs = search_interfaces("ZONE_DMZ", config)
-vpn_ifs = search_interfaces("ZONE_VPN", config)
-all_ifs = search_interfaces("ZONE_ALL", config)
+    current_data = None
 
-# read the zones template
-with open(zonesTemplatePath, "r") as f:
-    data = f.read()
+    if os.path.exists(zonesRulesetPath):
+        with open(zonesRulesetPath, "r", encoding="utf-8") as f:
+            current_data = f.read()
 
-output_data = data.format(local_interfaces=local_ifs, lan_interfaces=lan_ifs,
-                          wan_interfaces=wan_ifs, dmz_interfaces=dmz_ifs,
-                          vpn_interfaces=vpn_ifs, all_interfaces=all_ifs)
+    if not current_data or current_data != output_data:
+        # different file content, write the ruleset file
+        with open(zonesRulesetPath, "w") as f:
+            f.write(output_data)
+        return True
+    return False
 
-# Do not write the ruleset file if it already exists and there is no change.
-# This prevents unneccessary firewall setup changes.
+def request_reload():
+    # triggers firewall-config.path and thus a reload of the whole ruleset
+    with open(zonesChangedPath, "w") as f:
+        f.write("%f\n" % time.time())
 
-current_data = None
+def hash_file(path):
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    except OSError:
+        # gets included nevertheless, nft will complain about it
+        return "-"
+    return h.hexdigest()
 
-if os.path.exists(zonesRulesetPath):
-    with open(zonesRulesetPath, "r", encoding="utf-8") as f:
-        current_data = f.read()
+def write_config():
+    # read the firewall template
+    with open(configTemplatePath, "r") as f:
+        data = f.read()
 
-if not current_data or current_data != output_data:
-    # different file content, write the ruleset file
-    with open(zonesRulesetPath, "w") as f:
+    serviceFiles = []
+    for path in filter(os.path.exists, servicePaths):
+        serviceFiles += [os.path.realpath(os.path.join(path, f)) for f in sorted(os.listdir(path))]
+
+    service_file_blob = "\n".join(['include "%s"' % f for f in serviceFiles])
+
+    output_data = data.format(service_chains=service_file_blob)
+
+    # The ruleset only needs to be loaded again when it or one of the files
+    # it includes changed. zones.ruleset also gets modified when the daemon
+    # has already updated the zone sets incrementally, so zones.changed
+    # stands in for it.
+    hashes = [(hashlib.sha256(output_data.encode("utf-8")).hexdigest(), configRulesetPath)]
+    for path in [variablesPath, zonesChangedPath] + serviceFiles:
+        hashes.append((hash_file(path), path))
+    hash_data = "".join(["%s  %s\n" % entry for entry in hashes])
+
+    current_hash_data = None
+
+    if os.path.exists(configHashPath) and os.path.exists(configRulesetPath):
+        with open(configHashPath, "r", encoding="utf-8") as f:
+            current_hash_data = f.read()
+
+    if current_hash_data == hash_data:
+        return
+
+    # write the ruleset file, then the hashes which trigger the reload
+    with open(configRulesetPath, "w") as f:
         f.write(output_data)
+    with open(configHashPath, "w") as f:
+        f.write(hash_data)
+
+def get_interface_indices():
+    # map interface indices to names, like the link events do
+    interfaces = {}
+    for name in get_interfaces():
+        try:
+            with open(os.path.join("/sys/class/net", name, "ifindex")) as f:
+                interfaces[int(f.read())] = name
+        except (OSError, ValueError):
+            # interface went away in the meantime
+            pass
+    return interfaces
+
+def parse_link_events(data, interfaces):
+    # Apply RTM_NEWLINK/RTM_DELLINK messages to the index -> name map.
+    # Returns True if an interface was added, removed or renamed.
+    changed = False
+    offset = 0
+    while offset + nlmsghdr.size <= len(data):
+        length, msgtype, flags, seq, pid = nlmsghdr.unpack_from(data, offset)
+        if length < nlmsghdr.size:
+            break
+        if msgtype in (RTM_NEWLINK, RTM_DELLINK):
+            family, iftype, index, ifflags, ifchange = ifinfomsg.unpack_from(data, offset + nlmsghdr.size)
+            name = None
+            attr = offset + nlmsghdr.size + ifinfomsg.size
+            while attr + rtattr.size <= offset + length:
+                attrlen, attrtype = rtattr.unpack_from(data, attr)
+                if attrlen < rtattr.size:
+                    break
+                if attrtype == IFLA_IFNAME:
+                    name = data[attr + rtattr.size:attr + attrlen].split(b"\0", 1)[0].decode("utf-8", "replace")
+                attr += (attrlen + 3) & ~3
+            if msgtype == RTM_NEWLINK and name and interfaces.get(index) != name:
+                interfaces[index] = name
+                changed = True
+            elif msgtype == RTM_DELLINK and index in interfaces:
+                del interfaces[index]
+                changed = True
+        offset += (length + 3) & ~3
+    return changed
+
+def apply_zone_changes(old, new):
+    # Add and remove set elements in a single nft transaction. Interfaces
+    # are referred to by index, which also works for removed interfaces.
+    # Returns False if the sets could not be updated, for example because
+    # the ruleset has not been loaded yet.
+    commands = []
+    for key, field in zones:
+        added = new.get(key, set()) - old.get(key, set())
+        removed = old.get(key, set()) - new.get(key, set())
+        if added:
+            commands.append("add element %s %s { %s }" % (zonesTable, key, ", ".join(map(str, sorted(added)))))
+        if removed:
+            commands.append("delete element %s %s { %s }" % (zonesTable, key, ", ".join(map(str, sorted(removed)))))
+    if not commands:
+        return True
+
+    try:
+        subprocess.run([nftPath, "-f", "-"], input="\n".join(commands) + "\n",
+                       universal_newlines=True, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("Incremental zone update failed, reloading the ruleset: %s" % (getattr(e, "stderr", None) or e),
+              file=sys.stderr)
+        return False
+    return True
+
+def run_daemon(incremental):
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    sock.bind((0, RTMGRP_LINK))
 
-if "--only-zones" in sys.argv:
-    # configured to run only zone update
-    sys.exit(0)
+    # Subscribe before listing the interfaces, so that no change gets lost.
+    config = ZonesConfig()
+    interfaces = get_interface_indices()
+    with lock():
+        if write_zones(config, interfaces.values()):
+            request_reload()
+    # the zone members as they are in the kernel once zones.ruleset is loaded
+    members = config.classify(interfaces)
 
-# read the firewall template
-with open(configTemplatePath, "r") as f:
-    data = f.read()
+    first = None
+    deadline = None
+    while True:
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        ready, _, _ = select.select([sock], [], [], timeout)
+        if ready:
+            try:
+                changed = parse_link_events(sock.recv(65536), interfaces)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # events were dropped, start over from the current state
+                interfaces = get_interface_indices()
+                changed = True
+            if changed:
+                now = time.monotonic()
+                if first is None:
+                    first = now
+                deadline = min(now + debounceDelay, first + maxDelay)
+        # Checked after receiving too, because a steady stream of link
+        # messages would otherwise postpone the update beyond maxDelay.
+        if deadline is not None and time.monotonic() >= deadline:
+            first = deadline = None
+            with lock():
+                if not config.is_current():
+                    # a new configuration always needs a full reload
+                    config = ZonesConfig()
+                    reload = write_zones(config, interfaces.values())
+                else:
+                    # zones.ruleset gets updated first in any case, so that
+                    # it matches the sets when the ruleset is loaded again
+                    reload = write_zones(config, interfaces.values())
+                    if incremental:
+                        reload = not apply_zone_changes(members, config.classify(interfaces))
+                if reload:
+                    request_reload()
+                members = config.classify(interfaces)
 
-serviceFiles = []
-for path in filter(os.path.exists, servicePaths):
-    serviceFiles += [os.path.realpath(os.path.join(path, f)) for f in os.listdir(path)]
+if __name__ == "__main__":
+    if "--daemon" in sys.argv:
+        run_daemon("--incremental" in sys.argv)
 
-service_file_blob = "\n".join(['include "%s"' % f for f in serviceFiles])
+    with lock():
+        if write_zones(ZonesConfig(), get_interfaces()):
+            request_reload()
 
-output_data = data.format(service_chains=service_file_blob)
+        if "--only-zones" in sys.argv:
+            # configured to run only zone update
+            sys.exit(0)
 
-# write the ruleset file
-with open(configRulesetPath, "w") as f:
-    f.write(output_data)
+        write_config()
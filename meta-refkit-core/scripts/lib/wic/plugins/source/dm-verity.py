@@ -24,12 +24,17 @@
 #
 
 import base64
+import concurrent.futures
 import glob
+import hashlib
 import logging
+import mmap
 import os
-import re
 import shutil
+import struct
 import tempfile
+import time
+import uuid
 
 from wic import WicError
 from wic.pluginbase import SourcePlugin
@@ -37,6 +42,96 @@ from wic.misc import (exec_cmd, exec_native_cmd, get_bitbake_var)
 
 logger = logging.getLogger('wic')
 
+# The defaults of "veritysetup format".
+VERITY_HASH = 'sha256'
+VERITY_BLOCK_SIZE = 4096
+VERITY_SALT_SIZE = 32
+
+# struct verity_sb from cryptsetup's lib/verity/verity.c: signature,
+# version, hash type, uuid, algorithm, data block size, hash block size,
+# number of data blocks, salt size, padding, salt, padding.
+VERITY_SB = struct.Struct('<8sII16s32sIIQH6x256s168x')
+
+# Number of data blocks hashed by one job. Each job produces complete
+# blocks of the lowest hash level.
+VERITY_CHUNK_BLOCKS = 32768
+
+def verity_hash_blocks(data, salt, first, count, block_size):
+    """
+    Returns the concatenated salted digests of 'count' blocks in 'data',
+    starting with block 'first'. The data gets copied in block-sized
+    pieces, with hashlib releasing the GIL while hashing them.
+    """
+    salted = hashlib.new(VERITY_HASH, salt)
+    zero = bytes(block_size)
+    zero_digest = None
+    digests = []
+    for offset in range(first * block_size, (first + count) * block_size, block_size):
+        block = data[offset:offset + block_size]
+        if block == zero:
+            # Common in file system images, no need to hash those again.
+            if zero_digest is None:
+                h = salted.copy()
+                h.update(zero)
+                zero_digest = h.digest()
+            digests.append(zero_digest)
+        else:
+            h = salted.copy()
+            h.update(block)
+            digests.append(h.digest())
+    return b''.join(digests)
+
+def verity_format(data_file, hash_file, hash_offset, jobs=None):
+    """
+    Equivalent of "veritysetup format <data_file> <hash_file> --hash-offset=<hash_offset>"
+    with the default parameters (format version 1, sha256, 4096 byte blocks,
+    random salt and UUID), producing the same superblock and hash tree.
+    The data blocks are hashed in parallel. The content of hash_file before
+    hash_offset is left zero. Returns the root hash as hex string.
+    """
+    block_size = VERITY_BLOCK_SIZE
+    digest_size = hashlib.new(VERITY_HASH).digest_size
+    # The number of digests per hash block is rounded down to a power of two,
+    # the rest of each block is zero.
+    hashes_per_block = 1 << ((block_size // digest_size).bit_length() - 1)
+    salt = os.urandom(VERITY_SALT_SIZE)
+
+    with open(data_file, 'rb') as f:
+        data_blocks = os.fstat(f.fileno()).st_size // block_size
+        if not data_blocks:
+            raise WicError('%s is too small for dm-verity' % data_file)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            def hash_chunk(first):
+                return verity_hash_blocks(data, salt, first, min(VERITY_CHUNK_BLOCKS, data_blocks - first), block_size)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+                digests = b''.join(executor.map(hash_chunk, range(0, data_blocks, VERITY_CHUNK_BLOCKS)))
+
+    # Each level packs the digests of the level below into hash blocks, until
+    # a single block is left. Its digest is the root hash. The levels are
+    # stored top-down after the superblock.
+    levels = []
+    count = data_blocks
+    while count > 1:
+        level = bytearray()
+        for start in range(0, count * digest_size, hashes_per_block * digest_size):
+            block = digests[start:start + hashes_per_block * digest_size]
+            level += block + bytes(block_size - len(block))
+        levels.insert(0, level)
+        count = len(level) // block_size
+        digests = verity_hash_blocks(level, salt, 0, count, block_size)
+
+    superblock = VERITY_SB.pack(b'verity', 1, 1, uuid.uuid4().bytes, VERITY_HASH.encode('ascii'),
+                                block_size, block_size, data_blocks, len(salt), salt)
+    tree_offset = (hash_offset + VERITY_SB.size + block_size - 1) // block_size * block_size
+    with open(hash_file, 'wb') as f:
+        f.seek(hash_offset)
+        f.write(superblock)
+        f.seek(tree_offset)
+        for level in levels:
+            f.write(level)
+        f.truncate(tree_offset + sum([len(level) for level in levels]))
+    return digests.hex()
+
 class DMVerityPlugin(SourcePlugin):
     """
     Creates dm-verity hash data for one rootfs partition, as identified by
@@ -74,41 +169,36 @@ class DMVerityPlugin(SourcePlugin):
         # <potentially some more assignments in the future>
         # signature=<single line of base64 encoded OpenSSL sha256 digest>
         header_size = 4096
-        ret, out = exec_native_cmd("veritysetup format '%s' '%s' --hash-offset=%d" %
-                                   (rootfs, hashimg, header_size),
-                                   native_sysroot)
-        m = re.search(r'^Root hash:\s*(\S+)$', out, re.MULTILINE)
-        if ret or not m:
-            raise WicError('veritysetup failed: %s' % out)
-        else:
-            root_hash = m.group(1)
-            privkey = get_bitbake_var('REFKIT_DMVERITY_PRIVATE_KEY')
-            password = get_bitbake_var('REFKIT_DMVERITY_PASSWORD')
-            tmp = tempfile.mkdtemp(prefix='dm-verity-')
-            try:
-                data_filename = os.path.join(tmp, 'data')
-                header = ('roothash=%s\nheadersize=%d\n' % (root_hash, header_size)).encode('ascii')
-                with open(data_filename, 'wb') as data:
-                    data.write(header)
-                # Must use a temporary file, exec_native_cmd() only supports UTF-8 output.
-                signature = os.path.join(tmp, 'sig')
-                ret, out = exec_native_cmd("openssl dgst -sha256 -passin '%s' -sign '%s' -out '%s' '%s'" %
-                                           (password, privkey, signature, data_filename),
-                                           native_sysroot)
-                if ret:
-                    raise WicError('openssl signing failed')
-                with open(signature, 'rb') as f:
-                    header += b'signature=' + base64.standard_b64encode(f.read()) + b'\n'
-                if len(header) + 1 >= header_size:
-                    raise WicError('reserved space for dm-verity header too small')
-                with open(hashimg, 'rb+') as hash:
-                    hash.write(header)
-            finally:
-                shutil.rmtree(tmp)
-
-            data_bytes = os.stat(rootfs).st_size
-            hash_bytes = os.stat(hashimg).st_size
-            logger.debug("dm-verity data partition %d bytes, hash partition %d bytes, ratio %f." %
-                        (data_bytes, hash_bytes, data_bytes / hash_bytes))
-            part.size = data_bytes // 1024
-            part.source_file = hashimg
+        start = time.time()
+        root_hash = verity_format(rootfs, hashimg, header_size)
+        logger.debug("dm-verity hash tree for %s calculated in %.1fs." % (rootfs, time.time() - start))
+        privkey = get_bitbake_var('REFKIT_DMVERITY_PRIVATE_KEY')
+        password = get_bitbake_var('REFKIT_DMVERITY_PASSWORD')
+        tmp = tempfile.mkdtemp(prefix='dm-verity-')
+        try:
+            data_filename = os.path.join(tmp, 'data')
+            header = ('roothash=%s\nheadersize=%d\n' % (root_hash, header_size)).encode('ascii')
+            with open(data_filename, 'wb') as data:
+                data.write(header)
+            # Must use a temporary file, exec_native_cmd() only supports UTF-8 output.
+            signature = os.path.join(tmp, 'sig')
+            ret, out = exec_native_cmd("openssl dgst -sha256 -passin '%s' -sign '%s' -out '%s' '%s'" %
+                                       (password, privkey, signature, data_filename),
+                                       native_sysroot)
+            if ret:
+                raise WicError('openssl signing failed')
+            with open(signature, 'rb') as f:
+                header += b'signature=' + base64.standard_b64encode(f.read()) + b'\n'
+            if len(header) + 1 >= header_size:
+                raise WicError('reserved space for dm-verity header too small')
+            with open(hashimg, 'rb+') as hash:
+                hash.write(header)
+        finally:
+            shutil.rmtree(tmp)
+
+        data_bytes = os.stat(rootfs).st_size
+        hash_bytes = os.stat(hashimg).st_size
+        logger.debug("dm-verity data partition %d bytes, hash partition %d bytes, ratio %f." %
+                    (data_bytes, hash_bytes, data_bytes / hash_bytes))
+        part.size = data_bytes // 1024
+        part.source_file = hashimg